@@ -0,0 +1,240 @@
+#!/usr/bin/python
+
+# ---------------------------------------------------------------------------
+#
+# Copyright (c) 2010 David Hanney
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# ---------------------------------------------------------------------------
+
+# for py2.5:
+from __future__ import division
+from __future__ import with_statement
+# for py3:
+from __future__ import print_function
+
+# ---------------------------------------------------------------------------
+
+import os
+import struct
+import tarfile
+import zipfile
+import threading
+
+import dlib
+import recursive_lister
+
+# ---------------------------------------------------------------------------
+#
+# The members of zip and tar files that are stored as they are (not
+# compressed, encrypted or sparse) as files in their own right, each at an
+# offset in its archive, so they can be read in place without extracting.
+#
+# A member has a path through its archive - 'a/b.zip/c/d' - or through the
+# folder the archive stands in for when that folder isn't there itself -
+# 'a/b/c/d' for a b.zip holding 'c/d' or 'b/c/d', as made by "zip -r0 b.zip b".
+#
+# ---------------------------------------------------------------------------
+
+EXTENSIONS = ('.zip', '.tar')
+
+def is_archive(path):
+	return os.path.splitext(path)[1].lower() in EXTENSIONS
+
+def _clean(name):
+	while name.startswith('./'): name = name[2:]
+	return name.lstrip('/')
+
+def _zip_name(info):
+	# zipfile decodes names as cp437 unless flagged as utf-8, or on python 2 leaves them be
+	name = info.filename
+	if isinstance(name, bytes): return name
+	if info.flag_bits & 0x800: return dlib.fs_str(name.encode('utf-8'))
+	return dlib.fs_str(name.encode('cp437'))
+
+# the fixed part of a zip local file header, before its name and extra field
+_LOCAL_HEADER = struct.Struct('<4s22xHH')
+
+def zip_members(path):
+	"""{ name: (offset, size) } of the stored members of a zip file"""
+	members = {}
+	with open(path, 'rb') as f:
+		z = zipfile.ZipFile(f)
+		for info in z.infolist():
+			if info.filename.endswith('/') or info.compress_type!=zipfile.ZIP_STORED or info.flag_bits & 0x1: continue
+			# the local header's extra field needn't be the central directory's
+			f.seek(info.header_offset)
+			header = f.read(_LOCAL_HEADER.size)
+			if len(header)!=_LOCAL_HEADER.size: continue
+			magic, name_length, extra_length = _LOCAL_HEADER.unpack(header)
+			if magic!=b'PK\x03\x04': continue
+			members[_clean(_zip_name(info))] = (info.header_offset+_LOCAL_HEADER.size+name_length+extra_length, info.file_size)
+	return members
+
+def tar_members(path):
+	"""{ name: (offset, size) } of the regular members of an uncompressed tar file"""
+	members = {}
+	t = tarfile.open(path, 'r:')
+	try:
+		for info in t:
+			if info.isreg() and not info.issparse():
+				members[_clean(info.name)] = (info.offset_data, info.size)
+	finally:
+		t.close()
+	return members
+
+def members_of(path):
+	"""{ name: (offset, size) } of an archive's stored members - none if it
+	isn't one we can read in place"""
+	try:
+		if os.path.splitext(path)[1].lower()=='.zip': return zip_members(path)
+		return tar_members(path)
+	except (zipfile.BadZipfile, tarfile.TarError, EnvironmentError, EOFError):
+		return {}
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+class _Archive(object):
+	def __init__(self, path):
+		self.path = path
+		self.members = members_of(path)
+		self.folders = set([ '' ])
+		for name in self.members:
+			parts = name.split('/')
+			for i in range(1, len(parts)): self.folders.add('/'.join(parts[:i]))
+
+	def name(self, inner, stand_in):
+		# the member or folder inner is, or None
+		for name in ([ stand_in+'/'+inner if inner else stand_in, inner ] if stand_in else [ inner ]):
+			if name in self.members or name in self.folders: return name
+		return None
+
+class Archives(object):
+	# the member tables of the archives seen lately, by identity so a changed
+	# archive is looked at afresh
+	MAX_ARCHIVES = 256
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._archives = {}
+
+	def _archive(self, path):
+		st = os.stat(path)
+		key = (path, st.st_dev, st.st_ino, st.st_size, dlib.stat_mtime_ns(st))
+		with self._lock:
+			archive = self._archives.get(key)
+		if archive is None:
+			archive = _Archive(path)
+			with self._lock:
+				if len(self._archives)>=self.MAX_ARCHIVES: self._archives.clear()
+				self._archives[key] = archive
+		return archive
+
+	def _find(self, path):
+		# (archive, name within it) for a path into one, or None
+		path = os.path.abspath(path)
+		rest = []
+		while True:
+			if os.path.isfile(path):
+				if not rest or not is_archive(path): return None
+				archive = self._archive(path)
+				name = archive.name('/'.join(reversed(rest)), None)
+				return (archive, name) if name is not None else None
+			if os.path.isdir(path): return None
+			head, tail = os.path.split(path)
+			if not tail: return None
+			for extension in EXTENSIONS:
+				if os.path.isfile(path+extension):
+					archive = self._archive(path+extension)
+					name = archive.name('/'.join(reversed(rest)), tail)
+					if name is not None: return (archive, name)
+			rest.append(tail)
+			path = head
+
+	def member(self, path):
+		"""(archive path, offset, size) if path is a member, else None"""
+		found = self._find(path)
+		if found is None or found[1] not in found[0].members: return None
+		offset, size = found[0].members[found[1]]
+		return (found[0].path, offset, size)
+
+	def isdir(self, path):
+		found = self._find(path)
+		return found is not None and found[1] in found[0].folders
+
+	def listing(self, path):
+		"""the files under path - a folder, an archive or a folder in one - as
+		recursive_lister has them, with the members of the archives among them"""
+		found = self._find(path)
+		if found is None:
+			answer = []
+			for f in recursive_lister.recursive_lister(path):
+				answer.append(f)
+				if is_archive(f):
+					answer.extend([ os.path.join(f, *name.split('/')) for name in sorted(self._archive(f).members) ])
+			return answer
+		archive, folder = found
+		prefix = folder+'/' if folder else ''
+		return [ os.path.join(path, *name[len(prefix):].split('/')) for name in sorted(archive.members) if name.startswith(prefix) ]
+
+# ---------------------------------------------------------------------------
+
+if __name__ == "__main__":
+	import tempfile
+
+	d = tempfile.mkdtemp()
+	show = os.path.join(d, 'show')
+	os.makedirs(os.path.join(show, 'extras'))
+	for name, data in (('e01', b'one'*1000), ('e02', b'two'*1000), ('extras/x', b'x')):
+		dlib.save_file(os.path.join(show, *name.split('/')), data)
+	z = zipfile.ZipFile(os.path.join(d, 'show.zip'), 'w', zipfile.ZIP_STORED)
+	for name in ('e01', 'e02', 'extras/x'):
+		z.write(os.path.join(show, *name.split('/')), 'show/'+name)
+	z.writestr('packed', b'p'*1000, zipfile.ZIP_DEFLATED)
+	z.close()
+	t = tarfile.open(os.path.join(d, 'more.tar'), 'w')
+	t.add(show, 'show')
+	t.close()
+	archives = Archives()
+	def read(path):
+		container, offset, size = archives.member(path)
+		with open(container, 'rb') as f:
+			f.seek(offset)
+			return f.read(size)
+	assert read(os.path.join(d, 'show.zip', 'show', 'e02'))==b'two'*1000
+	assert read(os.path.join(d, 'more.tar', 'show', 'extras', 'x'))==b'x'
+	assert archives.member(os.path.join(d, 'show.zip', 'packed')) is None
+	assert archives.member(os.path.join(show, 'e01')) is None
+	assert archives.isdir(os.path.join(d, 'show.zip', 'show', 'extras')) and not archives.isdir(os.path.join(d, 'show.zip', 'e01'))
+	listing = archives.listing(d)
+	assert os.path.join(d, 'more.tar', 'show', 'e01') in listing and os.path.join(d, 'show.zip', 'show', 'extras', 'x') in listing
+	assert archives.listing(os.path.join(d, 'more.tar', 'show', 'extras'))==[ os.path.join(d, 'more.tar', 'show', 'extras', 'x') ]
+	# the archive stands in for the folder once it is gone
+	dlib.rm_minus_r(show)
+	os.remove(os.path.join(d, 'more.tar'))
+	assert read(os.path.join(show, 'e01'))==b'one'*1000 and archives.isdir(show)
+	assert archives.listing(show)==[ os.path.join(show, 'e01'), os.path.join(show, 'e02'), os.path.join(show, 'extras', 'x') ]
+	dlib.rm_minus_r(d)
+	print("archives works")
+
+# ---------------------------------------------------------------------------
@@ -30,6 +30,8 @@
 # for py2.5:
 from __future__ import division
 from __future__ import with_statement
+# for py3:
+from __future__ import print_function
 
 # ---------------------------------------------------------------------------
 
@@ -45,7 +47,7 @@ class BadOptions(Exception):
 class Args:
 	def __init__(self, a=None):
 		from sys import argv
-		if not a: a = argv[1:]
+		if a is None: a = argv[1:]
 		self._a = a
 
 	@staticmethod
@@ -110,7 +112,7 @@ class Args:
 			#print s, options
 			return options[s]
 		except KeyError:
-			fail()
+			Args.fail()
 
 	def get_one_of(self, options):
 		return Args.one_of(self.get_str(), options)
@@ -118,6 +120,14 @@ class Args:
 	def get_int(self, min_value=None, max_value=None):
 		return Args._parse_int(self.get_str(), min_value, max_value)
 
+	def get_memsize(self):
+		# e.g. "512k" or "1.5m"
+		from dlib import get_memsize
+		try:
+			return get_memsize(self.get_str())
+		except Exception:
+			raise BadOptions
+
 # ---------------------------------------------------------------------------
 
 if __name__ == "__main__":
@@ -125,9 +135,9 @@ if __name__ == "__main__":
 
 	while a.on_an_option():
 		if a.option_is('ab'):
-			print 'ab'
+			print('ab')
 		elif a.option_is('cd'):
-			print 'cd', a.get_int()
+			print('cd', a.get_int())
 		else:
 			a.unknown_option()
 
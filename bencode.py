@@ -30,20 +30,32 @@
 # for py2.5:
 from __future__ import division
 from __future__ import with_statement
+# for py3:
+from __future__ import print_function
 
 # ---------------------------------------------------------------------------
 
-import StringIO
+import io
 import re
 from dlib import *
-import types
 from inputstreams import FileInputStream
 
 # ---------------------------------------------------------------------------
+#
+# Strings decode to bytes (str on python 2) and dict keys with them, so a
+# .torrent's keys are looked up as b'info', b'pieces' and so on.
+#
 
 def get_number(stream, e):
 	return int(stream.get_until(e))
 
+def _ascii(t):
+	return t.encode('ascii')
+
+def _shown(k):
+	# a key as it appears in messages, the same under python 2 or 3
+	return fs_str(k) if isinstance(k, bytes) else k
+
 # ---------------------------------------------------------------------------
 
 class CodingException(Exception):
@@ -59,45 +71,45 @@ class CodableType:
 
 def encode_unicode(root, stream, value):
 	value = value.encode('utf-8')
-	stream.write('u'+str(len(value))+':')
+	stream.write(_ascii('u'+str(len(value))+':'))
 	stream.write(value)
 
 def decode_unicode(root, stream):
 	stream.skip()
-	len = get_number(stream, ':')
+	len = get_number(stream, b':')
 	return stream.get(len).decode("utf-8")
 
 ct_unicode = CodableType(encode_unicode, decode_unicode, unicode, "u")
 
 def encode_none(root, stream, value):
-	stream.write('n')
+	stream.write(b'n')
 
 def decode_none(root, stream):
 	stream.skip()
 	return None
 			
-ct_none = CodableType(encode_none, decode_none, types.NoneType, "n")
+ct_none = CodableType(encode_none, decode_none, type(None), "n")
 
 def encode_float(root, stream, value):
-	stream.write('f'+str(value)+'e')
+	stream.write(_ascii('f'+str(value)+'e'))
 
 def decode_float(root, stream):
 	stream.skip()
-	m = stream.get_until('e')
+	m = stream.get_until(b'e')
 	return float(m)
 
 ct_float = CodableType(encode_float, decode_float, float, "f")
 
 def encode_list(root, stream, value):
-	stream.write('l')
+	stream.write(b'l')
 	for item in value:
 		root.encode(item)
-	stream.write('e')
+	stream.write(b'e')
 
 def decode_list(root, stream):
 	stream.skip()
 	answer = []
-	while not stream.consume_if_possible('e'):
+	while not stream.consume_if_possible(b'e'):
 		v = root.decode()
 		answer.append(v)
 	return answer
@@ -105,21 +117,21 @@ def decode_list(root, stream):
 ct_list = CodableType(encode_list, decode_list, list, "l")
 
 def encode_str(root, stream, value):
-	stream.write(str(len(value))+':')
+	stream.write(_ascii(str(len(value))+':'))
 	stream.write(value)
 
 def decode_str(root, stream):
-	s = get_number(stream, ':')
+	s = get_number(stream, b':')
 	return stream.get(s)
 
-ct_string = CodableType(encode_str, decode_str, str, "0123456789")
+ct_string = CodableType(encode_str, decode_str, bytes, "0123456789")
 
 def encode_int(root, stream, value):
-	stream.write('i'+str(value)+'e')
+	stream.write(_ascii('i'+str(value)+'e'))
 
 def decode_int(root, stream):
 	stream.skip()
-	answer = get_number(stream, 'e')
+	answer = get_number(stream, b'e')
 	return answer
 
 ct_int = CodableType(encode_int, decode_int, int, "i")
@@ -138,7 +150,7 @@ def encode_direct(root, stream, value):
 ct_direct = CodableType(encode_direct, None, DirectValue, "")
 
 def validate_dict_keys(root, value):
-	keys = value.keys()
+	keys = list(value.keys())
 	key_types = set([ type(k) for k in keys ])
 	if len(key_types)>1:
 		raise CodingException("All keys must be the same type: "+repr(value))
@@ -151,17 +163,17 @@ def validate_dict_keys(root, value):
 def encode_dict(root, stream, value):
 	keys = validate_dict_keys(root, value)
 	keys.sort()
-	stream.write('d')
+	stream.write(b'd')
 	for key in keys:
 		root.encode(key)
 		root.encode(value[key])
-	stream.write('e')
+	stream.write(b'e')
 
 def decode_dict(root, stream):
 	stream.skip()
 	value = {}
 	first = True
-	while not stream.consume_if_possible('e'):
+	while not stream.consume_if_possible(b'e'):
 		k = root.decode()
 		if first:
 			last_k = k
@@ -170,7 +182,7 @@ def decode_dict(root, stream):
 			# http://wiki.theory.org/BitTorrentSpecification#dictionaries says:
 			#		Keys must be strings and appear in sorted order (sorted as raw strings, not alphanumerics).
 			#		The strings should be compared using a binary comparison, not a culture-specific "natural" comparison.
-			root.warning("Keys must be in order but {1!r} (the last key) and {0!r} (this key) are not.", k, last_k)
+			root.warning("Keys must be in order but {1!r} (the last key) and {0!r} (this key) are not.", _shown(k), _shown(last_k))
 		v = root.decode()
 		value[k] = v
 	if not root.config_get("decorate"):
@@ -202,7 +214,7 @@ class Decoder:
 		
 	def register(self, f, cs):
 		for c in cs:
-			self.m[c] = f
+			self.m[_ascii(c)] = f
 
 	def decode(self, root, stream):
 		return self.m.get(stream.peek(), self.default)(root, stream)
@@ -228,7 +240,7 @@ class Instance(object):
 	def must_be_permissible_dict_key(self, t):
 		p = self.root.permissible_dict_keys
 		if t not in p:
-			raise CodingException("Key must of type "+str(list(p))+" but is "+str(t)+": "+repr(value))
+			raise CodingException("Key must of type "+str(list(p))+" but is "+str(t))
 
 	def config_get(self, word, default=None):
 		return self.root.config.get(word, default)
@@ -242,7 +254,7 @@ class Coder:
 		self.e = Encoder()
 		self.d = Decoder()
 
-		self.permissible_dict_keys = set(config.get("permissible_dict_keys", [str] ))
+		self.permissible_dict_keys = set(config.get("permissible_dict_keys", [bytes] ))
 
 		self.register(ct_direct)
 		self.register(ct_list)
@@ -282,17 +294,152 @@ class Coder:
 		return self.decode_from_stream_with_messages(FileInputStream(file))
 
 	def encode_to_string(self, value):
-		file = StringIO.StringIO()
+		file = io.BytesIO()
 		self.encode_to_file(file, value)
 		return file.getvalue()
 		
 	def decode_from_string(self, string):
-		return self.decode_from_file(StringIO.StringIO(string))
+		return self.decode_from_file(io.BytesIO(string))
 		
 	def decode_from_string_with_messages(self, string):
-		return self.decode_from_file_with_messages(StringIO.StringIO(string))
+		return self.decode_from_file_with_messages(io.BytesIO(string))
 
 
+# ---------------------------------------------------------------------------
+#
+# Lazy decoding
+#
+# decodes straight out of a buffer (typically an mmap of the .torrent) and
+# only as far as is asked for: a dict or list just notes where its items are
+# the first time it is looked into and only decodes an item when it is
+# fetched. Strings can be left in place altogether with string_span().
+#
+# A byte is looked at as buf[p:p+1] as python 3 makes buf[p] an int.
+#
+
+def _find(buf, c, p):
+	# where the c that ends the integer or string length at p is
+	q = buf.find(c, p)
+	if q<0: raise CodingException(multistr("Ran out of data looking for", repr(_shown(c)), "from", p))
+	return q
+
+def _scan(buf, p):
+	# the offset just past the value starting at p
+	c = buf[p:p+1]
+	if c==b'i':
+		return _find(buf, b'e', p)+1
+	if c==b'l' or c==b'd':
+		p += 1
+		while buf[p:p+1]!=b'e':
+			p = _scan(buf, p)
+		return p+1
+	if c.isdigit():
+		colon = _find(buf, b':', p)
+		return colon+1+int(buf[p:colon])
+	raise CodingException(multistr("Don't know how to proceed with decode:", repr(_shown(c)), p))
+
+def _string_at(buf, p):
+	colon = _find(buf, b':', p)
+	return buf[colon+1:colon+1+int(buf[p:colon])]
+
+def _value_at(buf, p, warnings):
+	c = buf[p:p+1]
+	if c==b'd': return LazyDict(buf, p, warnings)
+	if c==b'l': return LazyList(buf, p, warnings)
+	if c==b'i': return int(buf[p+1:_find(buf, b'e', p)])
+	return _string_at(buf, p)
+
+class LazyDict(object):
+	def __init__(self, buf, start, warnings=None):
+		self._buf = buf
+		self.start = start
+		self._warnings = warnings if warnings is not None else []
+		self._spans = None
+		self._values = {}
+
+	def _index(self):
+		if self._spans is None:
+			buf = self._buf
+			spans = {}
+			last_k = None
+			p = self.start+1
+			while buf[p:p+1]!=b'e':
+				v = _scan(buf, p)
+				k = _string_at(buf, p)
+				if last_k is not None and k<=last_k:
+					self._warnings.append("Keys must be in order but {1!r} (the last key) and {0!r} (this key) are not.".format(_shown(k), _shown(last_k)))
+				last_k = k
+				p = _scan(buf, v)
+				spans[k] = (v, p)
+			self.end = p+1
+			self._spans = spans
+		return self._spans
+
+	def span(self, key):
+		return self._index()[key]
+
+	def string_span(self, key):
+		# where the characters of a string value lie, without copying them out
+		s, e = self.span(key)
+		return (self._buf.find(b':', s)+1, e)
+
+	def __getitem__(self, key):
+		if key not in self._values:
+			self._values[key] = _value_at(self._buf, self.span(key)[0], self._warnings)
+		return self._values[key]
+
+	def get(self, key, default=None):
+		if key in self: return self[key]
+		return default
+
+	def __contains__(self, key):
+		return key in self._index()
+
+	def __len__(self):
+		return len(self._index())
+
+	def keys(self):
+		return list(self._index().keys())
+
+	def iteritems(self):
+		for k in self.keys():
+			yield (k, self[k])
+
+class LazyList(object):
+	def __init__(self, buf, start, warnings=None):
+		self._buf = buf
+		self.start = start
+		self._warnings = warnings if warnings is not None else []
+		self._starts = None
+
+	def _index(self):
+		if self._starts is None:
+			buf = self._buf
+			starts = []
+			p = self.start+1
+			while buf[p:p+1]!=b'e':
+				starts.append(p)
+				p = _scan(buf, p)
+			self.end = p+1
+			self._starts = starts
+		return self._starts
+
+	def __getitem__(self, i):
+		return _value_at(self._buf, self._index()[i], self._warnings)
+
+	def __len__(self):
+		return len(self._index())
+
+	def __iter__(self):
+		for p in self._index():
+			yield _value_at(self._buf, p, self._warnings)
+
+def lazy_decode_with_messages(buf, offset=0):
+	"""the value at offset in buf, decoded lazily, and a list which fills up
+	with warnings as more of it is decoded"""
+	warnings = []
+	return (_value_at(buf, offset, warnings), warnings)
+
 # ---------------------------------------------------------------------------
 
 
@@ -304,67 +451,86 @@ def bencode(value):
 def bdecode(value):
 	return legacy_coder.decode_from_string(value)
 
-coder = Coder(unicode=True, float=True, none=True, permissible_dict_keys=[ int, str, unicode ])
+coder = Coder(unicode=True, float=True, none=True, permissible_dict_keys=[ int, bytes, unicode ])
 
 if __name__ == "__main__":
 	from example_bencoded import *
 
 
 	def test_roundtrip(value):
-		print "Trying", value
+		print("Trying", value)
 		rvalue = repr(value)
 		encoded = coder.encode_to_string(value)
-		print "Encoded to", encoded
+		print("Encoded to", encoded)
 		back = coder.decode_from_string(encoded)
-		print "Decoded to", back
+		print("Decoded to", back)
 		bvalue = repr(back)
 		assert rvalue == bvalue, multistr("Started with", rvalue, "but got back", bvalue)
-		print
+		print()
 
 	divider = "-" * 75
 
-	print divider
+	print(divider)
 
-	test_roundtrip({ u"fish": 5, u"cheese": [7, 8] })
-	test_roundtrip({ 3: 5, 2: [7, 8.3] })
-	test_roundtrip(["hello", [{ "alfred": "trashbat", "wombat": [7, 8] }]])
-	test_roundtrip(["hello", [{ "alfred": u"trashbat", "lard": [7, 8] }]])
-	print "round trips work"
+	test_roundtrip({ u"cheese": [7, 8], u"fish": 5 })
+	test_roundtrip({ 2: [7, 8.3], 3: 5 })
+	test_roundtrip([b"hello", [{ b"alfred": b"trashbat", b"wombat": [7, 8] }]])
+	test_roundtrip([b"hello", [{ b"alfred": u"trashbat", b"lard": [7, 8] }]])
+	print("round trips work")
 
-	print divider
+	print(divider)
 
 	value, messages = coder.decode_from_string_with_messages(elliot_torrent)
 	assert len(messages)==1
 	message = messages[0]
-	print message
+	print(message)
 	assert message=="Keys must be in order but 'created by' (the last key) and 'announce' (this key) are not."
-	print "messages work"
+	print("messages work")
 
-	print divider
+	print(divider)
 
-	decorating_coder = Coder(unicode=True, float=True, none=True, permissible_dict_keys=[ int, str, unicode ], decorate=True)
+	decorating_coder = Coder(unicode=True, float=True, none=True, permissible_dict_keys=[ int, bytes, unicode ], decorate=True)
 	d = decorating_coder.decode_from_string(flash_torrent)
 	#print repr(v)
 	assert type(d[2])==dict
 	answer = None
-	for k, v in d[2].iteritems():
-		if k[2]=='info':
+	for k, v in d[2].items():
+		if k[2]==b'info':
 			s, e = v[0], v[1]
-			print "info dict runs from {0} to {1}".format(s, e)
+			print("info dict runs from {0} to {1}".format(s, e))
 			info_content = flash_torrent[s:e]
 			answer = sha1hash_of_string(info_content)
 	assert answer=='ae31bd358f2b851756793fe4e375ec0f5aa4c359'
-	print "decoration works"
+	print("decoration works")
 
-	print divider
+	print(divider)
 
 	x = coder.decode_from_string(flash_torrent)
-	x['info'] = DirectValue(info_content)
+	x[b'info'] = DirectValue(info_content)
 	flash_torrent2 = coder.encode_to_string(x)
 	assert flash_torrent==flash_torrent2
-	print "round trips using DirectValue work"
-
-	print divider
+	print("round trips using DirectValue work")
+
+	print(divider)
+
+	lazy, messages = lazy_decode_with_messages(flash_torrent)
+	s, e = lazy.span(b'info')
+	assert sha1hash_of_string(flash_torrent[s:e])=='ae31bd358f2b851756793fe4e375ec0f5aa4c359'
+	info = coder.decode_from_string(flash_torrent)[b'info']
+	s, e = lazy[b'info'].string_span(b'pieces')
+	assert flash_torrent[s:e]==info[b'pieces']
+	assert lazy[b'info'][b'piece length']==info[b'piece length']
+	lazy, messages = lazy_decode_with_messages(elliot_torrent)
+	lazy.keys()
+	assert len(messages)==1
+	try:
+		lazy_decode_with_messages(flash_torrent[:len(flash_torrent)//2])[0].keys()
+		assert False
+	except CodingException:
+		pass
+	print("lazy decoding works")
+
+	print(divider)
 
 # ---------------------------------------------------------------------------
 
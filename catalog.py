@@ -0,0 +1,423 @@
+#!/usr/bin/python
+
+# ---------------------------------------------------------------------------
+#
+# Copyright (c) 2010 David Hanney
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# ---------------------------------------------------------------------------
+
+# for py2.5:
+from __future__ import division
+from __future__ import with_statement
+# for py3:
+from __future__ import print_function
+
+# ---------------------------------------------------------------------------
+
+import os
+import mmap
+import struct
+import hashlib
+import fcntl
+import tempfile
+import threading
+
+import dlib
+
+# ---------------------------------------------------------------------------
+#
+# A single binary file holding what we know about every torrent we have seen
+# so a sweep over thousands of .torrent files need not decode or solve the
+# ones that have not changed since last time.
+#
+# Layout:
+#
+#	header
+#	path table       - slot_count slots keyed by sha1 of the torrent's path
+#	info-hash table  - slot_count slots keyed by the torrent's info-hash
+#	heap             - the records themselves, appended as they are stored
+#
+# Both tables are open-addressed with linear probing and point into the
+# heap. A record that is re-stored at the same size or smaller is rewritten
+# in place, otherwise it is appended and the old copy becomes garbage. The
+# file is rebuilt when the tables get too full or the heap too wasteful.
+#
+# Processes sharing a catalog take turns through flock on <catalog>.lock -
+# not on the catalog itself, which a rebuild replaces under them.
+#
+# ---------------------------------------------------------------------------
+
+MAGIC = b'TSCAT001'
+
+HEADER = struct.Struct('<8sIIQQ')			# magic, slot_count, used (slots, in both tables), heap_end, garbage
+SLOT = struct.Struct('<20sQI')				# key, record offset, record length
+RECORD = struct.Struct('<QqQQQQ20s20sIB')	# see CatalogEntry._pack()
+LENGTH = struct.Struct('<I')
+FILE_LENGTH = struct.Struct('<Q')
+MTIME = struct.Struct('<q')
+
+EMPTY_KEY = b'\0' * 20
+
+INITIAL_SLOT_COUNT = 1024
+MAX_LOAD = 0.7
+
+FLAG_MULTIFILE = 1
+FLAG_SOLVED = 2
+FLAG_PADS = 4
+
+# ---------------------------------------------------------------------------
+
+class CatalogException(Exception):
+	def __init__(*a):
+		Exception.__init__(*a)
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def path_key(path):
+	return hashlib.sha1(dlib.fs_bytes(os.path.abspath(path))).digest()
+
+def file_identity(path):
+	st = os.stat(path)
+	return (st.st_size, dlib.stat_mtime_ns(st))
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+class CatalogEntry(object):
+	# torrent_path
+	# torrent_size, torrent_mtime_ns - identity of the .torrent when recorded
+	# name
+	# multifile
+	# files         - list of (path components, length) in torrent order
+	# pads          - indices into files of the BEP 47 pad files
+	# piece_length
+	# piece_count
+	# info_start, info_end - the span of the raw info dict within the .torrent
+	# info_hash     - binary sha1 of the raw info dict
+	# content_hash  - hex sha1 of the whole .torrent (as used by .solution)
+	# solution      - list of (mtime_ns, path relative to the torrent folder) or None
+
+	def __init__(self, **fields):
+		self.solution = None
+		self.pads = []
+		self.__dict__.update(fields)
+
+	def is_current(self):
+		try:
+			return file_identity(self.torrent_path)==(self.torrent_size, self.torrent_mtime_ns)
+		except OSError:
+			return False
+
+	def _pack(self):
+		flags = 0
+		if self.multifile: flags |= FLAG_MULTIFILE
+		if self.solution is not None: flags |= FLAG_SOLVED
+		if self.pads: flags |= FLAG_PADS
+		parts = [ RECORD.pack(self.torrent_size, self.torrent_mtime_ns, self.piece_length, self.piece_count,
+			self.info_start, self.info_end, self.info_hash, dlib.hex_to_binary(self.content_hash), len(self.files), flags) ]
+		def s(t):
+			t = dlib.fs_bytes(t)
+			parts.append(LENGTH.pack(len(t)))
+			parts.append(t)
+		s(os.path.abspath(self.torrent_path))
+		s(self.name)
+		for components, length in self.files:
+			parts.append(FILE_LENGTH.pack(length))
+			s('\0'.join(components))
+		if self.pads:
+			parts.append(LENGTH.pack(len(self.pads)))
+			for i in self.pads:
+				parts.append(LENGTH.pack(i))
+		if self.solution is not None:
+			for mtime_ns, path in self.solution:
+				parts.append(MTIME.pack(mtime_ns))
+				s(path)
+		return b''.join(parts)
+
+	@staticmethod
+	def _unpack(buf, offset):
+		(torrent_size, torrent_mtime_ns, piece_length, piece_count, info_start, info_end,
+			info_hash, content_hash, file_count, flags) = RECORD.unpack_from(buf, offset)
+		p = [offset+RECORD.size]
+		def s():
+			l = LENGTH.unpack_from(buf, p[0])[0]
+			p[0] += LENGTH.size
+			t = buf[p[0]:p[0]+l]
+			p[0] += l
+			return dlib.fs_str(t)
+		def n(st):
+			v = st.unpack_from(buf, p[0])[0]
+			p[0] += st.size
+			return v
+		torrent_path = s()
+		name = s()
+		files = []
+		for i in range(file_count):
+			length = n(FILE_LENGTH)
+			files.append( (s().split('\0'), length) )
+		pads = []
+		if flags & FLAG_PADS:
+			for i in range(n(LENGTH)):
+				pads.append(n(LENGTH))
+		solution = None
+		if flags & FLAG_SOLVED:
+			solution = []
+			for i in range(file_count):
+				mtime_ns = n(MTIME)
+				solution.append( (mtime_ns, s()) )
+		return CatalogEntry(torrent_path=torrent_path, torrent_size=torrent_size, torrent_mtime_ns=torrent_mtime_ns,
+			name=name, multifile=bool(flags & FLAG_MULTIFILE), files=files, pads=pads, piece_length=piece_length,
+			piece_count=piece_count, info_start=info_start, info_end=info_end, info_hash=info_hash,
+			content_hash=dlib.binary_to_hex(content_hash), solution=solution)
+
+# ---------------------------------------------------------------------------
+
+class Catalog(object):
+	def __init__(self, path):
+		self.path = path
+		self._lock = threading.Lock()
+		self._file = None
+		self._map = None
+		self._lock_file = open(path+'.lock', 'ab')
+		self._flock(fcntl.LOCK_EX)
+		try:
+			if not os.path.exists(path) or not os.path.getsize(path):
+				self._create(path, INITIAL_SLOT_COUNT, [])
+			self._open()
+		finally:
+			self._flock(fcntl.LOCK_UN)
+
+	def close(self):
+		self._unmap()
+		if self._lock_file: self._lock_file.close()
+		self._lock_file = None
+
+	# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+	def _flock(self, how):
+		fcntl.flock(self._lock_file.fileno(), how)
+
+	def _open(self):
+		self._file = open(self.path, 'r+b')
+		self._inode = os.fstat(self._file.fileno()).st_ino
+		self._map = mmap.mmap(self._file.fileno(), 0)
+		magic, self._slot_count, self._used, self._heap_end, self._garbage = HEADER.unpack_from(self._map, 0)
+		if magic!=MAGIC:
+			self._unmap()
+			raise CatalogException(dlib.multistr("Not a torrentsolver catalog:", self.path))
+
+	def _unmap(self):
+		if self._map: self._map.close()
+		if self._file: self._file.close()
+		self._map = self._file = None
+
+	def _reopen(self):
+		self._unmap()
+		self._open()
+
+	def _is_stale(self):
+		# another process has stored past the end of our mapping, or
+		# rebuilt the catalog and left us mapping the old file
+		if HEADER.unpack_from(self._map, 0)[3]!=self._heap_end: return True
+		try:
+			return os.stat(self.path).st_ino!=self._inode
+		except OSError:
+			return False
+
+	def _write_header(self):
+		HEADER.pack_into(self._map, 0, MAGIC, self._slot_count, self._used, self._heap_end, self._garbage)
+
+	@staticmethod
+	def _table_offset(slot_count, table):
+		return HEADER.size + table*slot_count*SLOT.size
+
+	@staticmethod
+	def _create(path, slot_count, records):
+		heap_start = Catalog._table_offset(slot_count, 2)
+		tables = [ bytearray(slot_count*SLOT.size), bytearray(slot_count*SLOT.size) ]
+		heap = []
+		heap_end = heap_start
+		used = 0
+		for keys, data in records:
+			for table, key in enumerate(keys):
+				if Catalog._insert_slot(tables[table], slot_count, key, heap_end, len(data)): used += 1
+			heap.append(data)
+			heap_end += len(data)
+		# write elsewhere then rename so readers never see a half written catalog
+		fd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path)+'.')
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				f.write(HEADER.pack(MAGIC, slot_count, used, heap_end, 0))
+				for table in tables: f.write(bytes(table))
+				for data in heap: f.write(data)
+			if os.path.exists(path): os.chmod(temp, os.stat(path).st_mode & 0o777)
+			os.rename(temp, path)
+		except:
+			if os.path.exists(temp): os.remove(temp)
+			raise
+
+	@staticmethod
+	def _insert_slot(table, slot_count, key, offset, length):
+		# returns whether the slot was a new one
+		i = struct.unpack_from('<I', key)[0] % slot_count
+		while True:
+			k = bytes(table[i*SLOT.size:i*SLOT.size+20])
+			if k==EMPTY_KEY or k==key:
+				SLOT.pack_into(table, i*SLOT.size, key, offset, length)
+				return k==EMPTY_KEY
+			i = (i+1) % slot_count
+
+	def _find_slot(self, table, key):
+		base = self._table_offset(self._slot_count, table)
+		i = struct.unpack_from('<I', key)[0] % self._slot_count
+		while True:
+			k, offset, length = SLOT.unpack_from(self._map, base+i*SLOT.size)
+			if k==key or k==EMPTY_KEY:
+				return (base+i*SLOT.size, k==key, offset, length)
+			i = (i+1) % self._slot_count
+
+	def _live_records(self):
+		base = self._table_offset(self._slot_count, 0)
+		for i in range(self._slot_count):
+			k, offset, length = SLOT.unpack_from(self._map, base+i*SLOT.size)
+			if k!=EMPTY_KEY:
+				entry = CatalogEntry._unpack(self._map, offset)
+				yield ( (k, entry.info_hash), self._map[offset:offset+length] )
+
+	def _rebuild(self, slot_count):
+		records = list(self._live_records())
+		self._unmap()
+		self._create(self.path, slot_count, records)
+		self._open()
+
+	# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+	def _lookup(self, table, key):
+		with self._lock:
+			# with no store half done
+			self._flock(fcntl.LOCK_SH)
+			try:
+				if self._is_stale(): self._reopen()
+				slot, found, offset, length = self._find_slot(table, key)
+				if not found: return None
+				return CatalogEntry._unpack(self._map, offset)
+			finally:
+				self._flock(fcntl.LOCK_UN)
+
+	def lookup(self, torrent_path):
+		"""the entry for torrent_path if the .torrent has not changed since it was stored"""
+		entry = self._lookup(0, path_key(torrent_path))
+		if entry and entry.is_current(): return entry
+		return None
+
+	def lookup_info_hash(self, info_hash):
+		# the info-hash table is never cleared, so a torrent replaced by
+		# another at the same path leaves its slot pointing at the new one's
+		# record (or the garbage of its own) - only its path can say
+		entry = self._lookup(1, info_hash)
+		if entry is None: return None
+		entry = self._lookup(0, path_key(entry.torrent_path))
+		if entry and entry.info_hash==info_hash: return entry
+		return None
+
+	def store(self, entry):
+		data = entry._pack()
+		key = path_key(entry.torrent_path)
+		with self._lock:
+			self._flock(fcntl.LOCK_EX)
+			try:
+				# another process may have grown or rebuilt the file since we mapped
+				# it, or changed the counts in its header
+				self._reopen()
+				# as many as two new slots, which may both be in the one table
+				if (self._used+2) > self._slot_count*MAX_LOAD:
+					self._rebuild(self._slot_count*2)
+				elif self._garbage > self._heap_end//2:
+					self._rebuild(self._slot_count)
+				self._store(key, entry.info_hash, data)
+			finally:
+				self._flock(fcntl.LOCK_UN)
+
+	def _store(self, key, info_hash, data):
+		slot, found, offset, length = self._find_slot(0, key)
+		if found and len(data)<=length:
+			# update in place
+			self._map[offset:offset+len(data)] = data
+			self._garbage += length-len(data)
+		else:
+			if found: self._garbage += length
+			else: self._used += 1
+			offset = self._heap_end
+			self._heap_end += len(data)
+			self._map.resize(self._heap_end)
+			self._map[offset:self._heap_end] = data
+		SLOT.pack_into(self._map, slot, key, offset, len(data))
+		info_slot, found = self._find_slot(1, info_hash)[:2]
+		if not found: self._used += 1
+		SLOT.pack_into(self._map, info_slot, info_hash, offset, len(data))
+		self._write_header()
+		self._map.flush()
+
+# ---------------------------------------------------------------------------
+
+if __name__ == "__main__":
+	d = tempfile.mkdtemp()
+	t = os.path.join(d, 'x.torrent')
+	dlib.save_file(t, b'd4:infod4:name1:xee')
+	size, mtime_ns = file_identity(t)
+	c = Catalog(os.path.join(d, 'catalog'))
+	for x in range(2000):
+		c.store(CatalogEntry(torrent_path=t if x==0 else t+str(x), torrent_size=size, torrent_mtime_ns=mtime_ns,
+			name='x', multifile=True, files=[ (['a', 'b'], 5), (['c'], 7) ], piece_length=16384, piece_count=1,
+			info_start=6, info_end=19, info_hash=hashlib.sha1(str(x).encode('ascii')).digest(), content_hash='ab'*20,
+			solution=[ (1, 'q'), (2, 'r/s') ] if x else None))
+	e = c.lookup(t)
+	assert e.files==[ (['a', 'b'], 5), (['c'], 7) ]
+	assert e.solution is None
+	assert e.pads==[]
+	e.solution = [ (5, 'z'), (6, 'y') ]
+	e.pads = [ 1 ]
+	c.store(e)
+	c.close()
+	c = Catalog(os.path.join(d, 'catalog'))
+	assert c.lookup(t).solution==[ (5, 'z'), (6, 'y') ]
+	assert c.lookup(t).pads==[ 1 ]
+	assert c.lookup_info_hash(hashlib.sha1(b'1999').digest()).solution==[ (1, 'q'), (2, 'r/s') ]
+	assert c.lookup(t+'5') is None # not current: no such .torrent
+	# another torrent at the same path, again and again
+	for x in range(3000):
+		e.info_hash = hashlib.sha1(b'again'+str(x).encode('ascii')).digest()
+		c.store(e)
+	assert c.lookup_info_hash(hashlib.sha1(b'again0').digest()) is None
+	assert c.lookup_info_hash(e.info_hash).torrent_path==t
+	# grown by another
+	other = Catalog(os.path.join(d, 'catalog'))
+	e.solution = [ (7, 'w'*100000), (8, 'v') ]
+	other.store(e)
+	assert c.lookup(t).solution[1]==(8, 'v')
+	other.close()
+	c.close()
+	dlib.rm_minus_r(d)
+	print("catalog works")
+
+# ---------------------------------------------------------------------------
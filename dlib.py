@@ -30,19 +30,68 @@
 # for py2.5:
 from __future__ import division
 from __future__ import with_statement
+# for py3:
+from __future__ import print_function
 
 # ---------------------------------------------------------------------------
 
 import os
+import sys
 import re
 import subprocess
 import shutil
 import itertools
 import base64
+import binascii
 import hashlib
-import cgi
 import time
 import inspect
+import mmap
+
+try:
+	from html import escape
+except ImportError:
+	from cgi import escape
+
+# ---------------------------------------------------------------------------
+#
+# Python 2 and 3
+#
+# ---------------------------------------------------------------------------
+
+# the contents of files and of .torrent files are bytes under either
+# filenames, and the names inside .torrent files, are str - on python 3 they
+# go to and from bytes as the filesystem would, so undecodable names survive
+
+PY3 = sys.version_info[0]>=3
+
+if PY3:
+	unicode = str
+
+	def fs_str(b):
+		return os.fsdecode(b)
+
+	def fs_bytes(s):
+		return os.fsencode(s)
+
+	def reraise(exc_info):
+		raise exc_info[1].with_traceback(exc_info[2])
+
+	def byte_view(buf, start, length):
+		# a window onto buf without copying
+		return memoryview(buf)[start:start+length]
+else:
+	def fs_str(b):
+		return b
+
+	def fs_bytes(s):
+		return s
+
+	exec("def reraise(exc_info):\n\traise exc_info[0], exc_info[1], exc_info[2]\n")
+
+	def byte_view(buf, start, length):
+		# python 2's memoryview can't look at an mmap
+		return buffer(buf, start, length)
 
 # ---------------------------------------------------------------------------
 #
@@ -78,7 +127,7 @@ def y_or_n(b, yes=True, no=False):
 
 def pairs(x):
     xiter = iter(x)
-    return itertools.izip(xiter,xiter)
+    return zip(xiter,xiter)
 
 def int_roundup(x, multiple):
 	return ((x+multiple-1)//multiple)*multiple
@@ -109,7 +158,7 @@ def is_unicode(t):
 	return type(t) == unicode
 
 def is_bytestring(t):
-	return type(t) == type("")
+	return type(t) == bytes
 
 def assert_unicode(t):
 	assert is_unicode(t)
@@ -152,35 +201,56 @@ def multistr(*things):
 def get_ext(src):
 	return re.sub(r"^.*\.", "", src)
 
+def stat_mtime_ns(st):
+	# os.stat() only grows st_mtime_ns in python 3.3
+	ns = getattr(st, 'st_mtime_ns', None)
+	if ns is None: ns = int(round(st.st_mtime*1000000000))
+	return ns
+
 def mtime_from_string(mtime):
-	if os.stat_float_times():
+	# python 3 always has float times
+	if getattr(os, 'stat_float_times', lambda: True)():
 		return float(mtime)
 	return int(mtime)
 
 def save_text(name, lines, newline=get_linesep()):
-	with open(name, 'w') as f:
+	with open(name, 'wb') as f:
 		for line in lines:
-			f.write(line+newline)
+			f.write(fs_bytes(line+newline))
+
+def save_text_atomically(name, lines, newline=get_linesep()):
+	# readers see either the old file or the new one, never half of one
+	temp = name+'.tmp'
+	save_text(temp, lines, newline)
+	os.rename(temp, name)
 
 def load_text(name):
-	with open(name, 'r') as f:
+	with open(name, 'rb') as f:
 		for line in f:
-			line = re.sub(r'[\r\n]+$', "", line)
+			line = re.sub(r'[\r\n]+$', "", fs_str(line))
 			yield line
 
 def load_file(name):
-	with open(name, 'r') as f:
+	with open(name, 'rb') as f:
 		return f.read()
 
+def map_file(name):
+	# the file's bytes, mapped rather than read in
+	with open(name, 'rb') as f:
+		if not os.fstat(f.fileno()).st_size: return b''
+		return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
 def save_file(name, data):
-	with open(name, 'w') as f:
+	with open(name, 'wb') as f:
 		f.write(data)
 
 class ReadAndCallException(IOError):
 	def __init__(*a):
 		IOError.__init__(*a)
 
-def read_and_call(file, start, length, function):
+READ_CHUNK_SIZE = 16*1024
+
+def read_and_call(file, start, length, function, chunk_size=READ_CHUNK_SIZE):
 	use_mmap = False
 
 	if use_mmap:
@@ -197,16 +267,16 @@ def read_and_call(file, start, length, function):
 			start += readable
 			length -= readable
 	else:
-		CHUNK_SIZE = 16*1024
+		CHUNK_SIZE = chunk_size
 		file.seek(start)
 		if file.tell()!=start:
-			raise ReadAndCallException, "mis-seek"
+			raise ReadAndCallException("mis-seek")
 			
 		while length:
 			readable = min(CHUNK_SIZE, length)
 			segment = file.read(readable)
 			if len(segment)!=readable:
-				raise ReadAndCallException, "under-read"
+				raise ReadAndCallException("under-read")
 			function(segment)
 			length -= readable
 
@@ -237,6 +307,12 @@ def remove_path(to_go, orig):
 	assert a == to_go, multistr(orig, 'must start with', to_go)
 	return b
 
+def remove_path_if_inside(to_go, orig):
+	# as remove_path but leaves anything from elsewhere as it was
+	prefix = os.path.join(to_go, '')
+	if orig.startswith(prefix): return orig[len(prefix):]
+	return orig
+
 
 # ---------------------------------------------------------------------------
 #
@@ -277,12 +353,18 @@ def plain_hex(a, z=0):
 	if z: a = a[:z].zfill(z)
 	return a
 
+def hex_to_binary(s):
+	return binascii.unhexlify(s)
+
+def binary_to_hex(b):
+	return str(binascii.hexlify(b).decode('ascii'))
+
 def hex_byte(x, pad=False):
 	width = 2 if pad else 0
 	return plain_hex(x, width)
 
 def base64enc(s):
-	s = base64.b64encode(s)
+	s = str(base64.b64encode(s).decode('ascii'))
 	s = re.sub(r"[\s=]+$", "", s)
 	return s
 
@@ -300,10 +382,13 @@ def base64dec(s):
 # ---------------------------------------------------------------------------
 
 def http_get(host, path):
-	import httplib
+	try:
+		from httplib import HTTPConnection
+	except ImportError:
+		from http.client import HTTPConnection
 	conn = None
 	try:
-		conn = httplib.HTTPConnection(host)
+		conn = HTTPConnection(host)
 		conn.request("GET", path)
 		r1 = conn.getresponse()
 		if r1.status!=200:
@@ -334,11 +419,11 @@ def scrunch_ip(s):
 # ---------------------------------------------------------------------------
 
 
-def compute_sha1sum_for_file(path):
+def compute_sha1sum_for_file(path, chunk_size=READ_CHUNK_SIZE):
 	sha1_hasher = hashlib.sha1()
-	with open(path, 'r') as f:
-		read_and_call(f, 0, os.path.getsize(path), lambda data: sha1_hasher.update(data))
-	return sha1_hasher.digest().encode('hex')
+	with open(path, 'rb') as f:
+		read_and_call(f, 0, os.path.getsize(path), lambda data: sha1_hasher.update(data), chunk_size)
+	return binary_to_hex(sha1_hasher.digest())
 
 def safely_get_sha1hash_and_mtime(f):
 	while True:
@@ -349,9 +434,10 @@ def safely_get_sha1hash_and_mtime(f):
 			return (hash, time_before)
 
 def sha1hash_of_string(s):
+	if is_unicode(s): s = unicode_to_utf8(s)
 	sha1_hasher = hashlib.sha1()
 	sha1_hasher.update(s)
-	return sha1_hasher.digest().encode('hex')
+	return binary_to_hex(sha1_hasher.digest())
 
 # ---------------------------------------------------------------------------
 #
@@ -373,11 +459,11 @@ MEM_SIZES_DICT = dict(MEM_SIZES)
 def get_memsize(s):
 	r = r"([\d\.]+)([a-zA-Z]*)$"
 	match = re.match(r, s)
-	if match is None: raise RuntimeException(multistr("Bad memsize:", s))
+	if match is None: raise RuntimeError(multistr("Bad memsize:", s))
 	x = float(match.group(1))
 	k = match.group(2)
 	letter_value = MEM_SIZES_DICT.get(k.lower())
-	if letter_value is None: raise RuntimeException(multistr("Bad memsize:", s))
+	if letter_value is None: raise RuntimeError(multistr("Bad memsize:", s))
 	return int(x * letter_value)
 
 def gen_memsize(x):
@@ -394,6 +480,16 @@ def gen_memsize(x):
 
 	return a + letter
 
+def compact_ranges(numbers):
+	# [1, 2, 3, 7, 9, 10] -> '1-3, 7, 9-10'
+	answer = []
+	for n in numbers:
+		if answer and answer[-1][1]==n-1:
+			answer[-1][1] = n
+		else:
+			answer.append([n, n])
+	return ', '.join([ str(a) if a==b else '{0}-{1}'.format(a, b) for a, b in answer ])
+
 def ordinalth(n):
 	# though use of this does rather lock us into English
 	# let's not use it for user messages
@@ -432,7 +528,7 @@ def char_range(*list):
 	for s, e in pairs(list):
 		s = opt_ord(s)
 		e = opt_ord(e)
-		answer.extend([ chr(x) for x in xrange(s, e-1) ])
+		answer.extend([ chr(x) for x in range(s, e-1) ])
 	return answer.get()
 
 
@@ -457,22 +553,23 @@ class Doc(object):
 	def write_raw(self, text):
 		self.content.append(text)
 	def write(self, text):
-		self.content.append(cgi.escape(text))
+		self.content.append(escape(text, False))
 	def get(self):
 		return self.content.get()
 
 def make_url(path, v=None):
-	import urllib
+	try:
+		from urllib import quote
+	except ImportError:
+		from urllib.parse import quote
 	a = StringBuilder(path)
 	if v:
 		a.append('?')
-		ks = v.keys()
-		ks.sort()
-		for e, k in enumerate(ks):
+		for e, k in enumerate(sorted(v)):
 			if e: a.append('&')
 			a.append(k)
 			a.append('=')
-			a.append(urllib.quote(v[k]))
+			a.append(quote(v[k]))
 	return a.get()
 
 
@@ -545,18 +642,18 @@ if __name__ == "__main__":
 	assert get_memsize("0.3")==0
 	assert get_memsize("13")==13
 
-	print gen_memsize(1)
-	print gen_memsize(1500)
-	print gen_memsize(1500*1024)
-	print gen_memsize(1500*1024*1024)
-	print gen_memsize(1500*1024*1024*1024)
-	print gen_memsize(1500*1024*1024*1024*1024)
+	print(gen_memsize(1))
+	print(gen_memsize(1500))
+	print(gen_memsize(1500*1024))
+	print(gen_memsize(1500*1024*1024))
+	print(gen_memsize(1500*1024*1024*1024))
+	print(gen_memsize(1500*1024*1024*1024*1024))
 
-	print make_url("/h")
-	print make_url("/h", {})
-	print make_url("/h", { 'meal': "chips" })
-	print make_url("/h", { 'meal': "chips", 'a': "yum" })
+	print(make_url("/h"))
+	print(make_url("/h", {}))
+	print(make_url("/h", { 'meal': "chips" }))
+	print(make_url("/h", { 'meal': "chips", 'a': "yum" }))
 
-	print multistr(1, 2)
+	print(multistr(1, 2))
 
-	print remove_path('a/b/c', 'a/b/c/d/e/f.txt')
+	print(remove_path('a/b/c', 'a/b/c/d/e/f.txt'))
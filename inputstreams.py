@@ -40,7 +40,7 @@ import re
 class FileInputStream(object):
 	def __init__(self, f):
 		self.f = f
-		self.putback = ''
+		self.putback = b''
 
 	def get(self, amount=1, stay=False):
 		answer = self.putback
@@ -74,7 +74,7 @@ class FileInputStream(object):
 	# --- these methods are specific to this kind of stream
 
 	def get_until(self, e):
-		a = ''
+		a = b''
 		while not self.consume_if_possible(e):
 			a = a + self.get()
 		return a
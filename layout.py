@@ -0,0 +1,271 @@
+#!/usr/bin/python
+
+# ---------------------------------------------------------------------------
+#
+# Copyright (c) 2010 David Hanney
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# ---------------------------------------------------------------------------
+
+# for py2.5:
+from __future__ import division
+from __future__ import with_statement
+# for py3:
+from __future__ import print_function
+
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import array
+import bisect
+import errno
+import struct
+
+import dlib
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+# ---------------------------------------------------------------------------
+#
+# Orders reads by where the data physically is, to cut down on seeking on
+# spinning or fragmented storage.
+#
+#	physical - by the disk address the FIEMAP ioctl gives for the data,
+#	           falling back to inode order for files whose filesystem
+#	           will not say
+#	inode    - by device, inode and offset within the file
+#	torrent  - as they come
+#
+# And says which parts of a file are holes (SEEK_DATA/SEEK_HOLE) so they can
+# be taken as zeros rather than read - half-downloaded or preallocated files
+# are often mostly holes.
+#
+# ---------------------------------------------------------------------------
+
+ORDERS = ('torrent', 'inode', 'physical')
+
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_EXTENT_LAST = 0x1
+FIEMAP_EXTENT_UNKNOWN = 0x2
+FIEMAP_MAX_OFFSET = 2**64-1
+EXTENTS_PER_CALL = 64
+
+# struct fiemap and struct fiemap_extent from linux/fiemap.h
+_FIEMAP = struct.Struct('=QQIIII')
+_EXTENT = struct.Struct('=QQQQQIIII')
+
+def fiemap(fd):
+	"""[ (logical, physical, length) ] of the extents of the open file, or
+	None if the filesystem (or the platform) will not tell us"""
+	if fcntl is None: return None
+	extents = []
+	start = 0
+	while True:
+		buf = array.array('B', [0])*(_FIEMAP.size+EXTENTS_PER_CALL*_EXTENT.size)
+		_FIEMAP.pack_into(buf, 0, start, FIEMAP_MAX_OFFSET, 0, 0, EXTENTS_PER_CALL, 0)
+		try:
+			fcntl.ioctl(fd, FS_IOC_FIEMAP, buf, True)
+		except (IOError, OSError):
+			return None
+		mapped = _FIEMAP.unpack_from(buf, 0)[3]
+		if not mapped: return extents
+		for i in range(mapped):
+			extent = _EXTENT.unpack_from(buf, _FIEMAP.size+i*_EXTENT.size)
+			logical, physical, length, flags = extent[0], extent[1], extent[2], extent[5]
+			if not flags & FIEMAP_EXTENT_UNKNOWN:
+				extents.append( (logical, physical, length) )
+			if flags & FIEMAP_EXTENT_LAST: return extents
+		start = logical+length
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+# os only has these from python 3.3
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+def data_map(fd, size):
+	"""[ (start, end) ] of the parts of the open file that hold data, or None
+	if the system can't say - the rest is holes, which read as zeros"""
+	if not sys.platform.startswith('linux'): return None
+	extents = []
+	offset = 0
+	try:
+		while offset<size:
+			try:
+				start = os.lseek(fd, offset, SEEK_DATA)
+			except OSError as e:
+				# nothing but hole from here to the end
+				if e.errno==errno.ENXIO: break
+				raise
+			end = min(os.lseek(fd, start, SEEK_HOLE), size)
+			extents.append( (start, end) )
+			offset = end
+	except OSError:
+		return None
+	return extents
+
+class DataMaps(object):
+	# the data maps of the files seen lately, by identity so a changed file
+	# is looked at afresh
+	MAX_FILES = 4096
+
+	def __init__(self):
+		self._maps = {}
+
+	def _extents(self, fd):
+		st = os.fstat(fd)
+		key = (st.st_dev, st.st_ino, st.st_size, dlib.stat_mtime_ns(st))
+		if key not in self._maps:
+			if len(self._maps)>=self.MAX_FILES: self._maps.clear()
+			extents = data_map(fd, st.st_size)
+			self._maps[key] = (st.st_size, extents, [ start for start, end in extents ] if extents else None)
+		return self._maps[key]
+
+	def runs(self, fd, start, length):
+		"""[ (start, length, whether it holds data) ] covering that much of the open file"""
+		size, extents, starts = self._extents(fd)
+		end = start+length
+		# past the end is for the read to fail on, not zeros
+		if extents is None or end>size: return [ (start, length, True) ]
+		runs = []
+		position = start
+		i = max(bisect.bisect_right(starts, start)-1, 0)
+		while position<end and i<len(extents):
+			a, b = extents[i]
+			i += 1
+			if b<=position: continue
+			if a>=end: break
+			if a>position:
+				runs.append( (position, a-position, False) )
+				position = a
+			run_end = min(b, end)
+			runs.append( (position, run_end-position, True) )
+			position = run_end
+		if position<end: runs.append( (position, end-position, False) )
+		return runs
+
+# the one a reader uses unless told otherwise
+data_maps = DataMaps()
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+class _FileLayout(object):
+	def __init__(self, path, physical):
+		st = os.stat(path)
+		self.dev = st.st_dev
+		self.ino = st.st_ino
+		self._logical = None
+		if physical:
+			fd = os.open(path, os.O_RDONLY)
+			try:
+				extents = fiemap(fd)
+			finally:
+				os.close(fd)
+			if extents:
+				self._logical = [ e[0] for e in extents ]
+				self._extents = extents
+
+	def key(self, offset):
+		if self._logical is not None:
+			i = bisect.bisect_right(self._logical, offset)-1
+			if i>=0:
+				logical, physical, length = self._extents[i]
+				if offset<logical+length:
+					return (self.dev, 0, physical+offset-logical)
+		# a hole, or a filesystem without FIEMAP
+		return (self.dev, 1, self.ino, offset)
+
+class ReadOrder(object):
+	def __init__(self, order):
+		assert order in ORDERS
+		self.order = order
+		self._layouts = {}
+
+	def _layout(self, path):
+		if path not in self._layouts:
+			try:
+				self._layouts[path] = _FileLayout(path, self.order=='physical')
+			except OSError:
+				self._layouts[path] = None
+		return self._layouts[path]
+
+	def arrange(self, pieces, segments_of):
+		"""pieces in the order to read them, segments_of(piece) giving the
+		(path, start, length) segments it is read from"""
+		if self.order=='torrent': return pieces
+		keyed = []
+		for piece in pieces:
+			# by the first segment actually read from disk (not a pad file's zeros)
+			read = [ (path, start) for path, start, length in segments_of(piece) if path is not None ]
+			layout = self._layout(read[0][0]) if read else None
+			# anything we can't stat goes last, in torrent order
+			keyed.append( ((0,)+layout.key(read[0][1]) if layout else (1,), piece) )
+		keyed.sort()
+		return [ piece for key, piece in keyed ]
+
+# ---------------------------------------------------------------------------
+
+if __name__ == "__main__":
+	import tempfile
+
+	d = tempfile.mkdtemp()
+	a = os.path.join(d, 'a')
+	b = os.path.join(d, 'b')
+	for p in (a, b):
+		with open(p, 'wb') as f:
+			f.write(b'x'*100000)
+			# so the data has been given somewhere on disk
+			f.flush()
+			os.fsync(f.fileno())
+	segments = { 0: [ (b, 0, 50000) ], 1: [ (b, 50000, 50000) ], 2: [ (a, 0, 50000) ], 3: [ (a, 50000, 50000) ] }
+	assert ReadOrder('torrent').arrange([ 0, 1, 2, 3 ], segments.get)==[ 0, 1, 2, 3 ]
+	by_inode = ReadOrder('inode').arrange([ 0, 1, 2, 3 ], segments.get)
+	assert by_inode==([ 2, 3, 0, 1 ] if os.stat(a).st_ino<os.stat(b).st_ino else [ 0, 1, 2, 3 ])
+	physical = ReadOrder('physical').arrange([ 0, 1, 2, 3 ], segments.get)
+	assert sorted(physical)==[ 0, 1, 2, 3 ] and physical.index(0)<physical.index(1) and physical.index(2)<physical.index(3)
+	# a file with data only in its middle
+	with open(a, 'wb') as f:
+		f.truncate(4*1024*1024)
+		f.seek(2*1024*1024)
+		f.write(b'y'*4096)
+		f.flush()
+		os.fsync(f.fileno())
+	with open(a, 'rb') as f:
+		maps = DataMaps()
+		runs = maps.runs(f.fileno(), 0, 4*1024*1024)
+		assert sum([ length for start, length, is_data in runs ])==4*1024*1024
+		assert [ start for start, length, is_data in runs if is_data ][:1] in ([ 0 ], [ 2*1024*1024 ])
+		if data_map(f.fileno(), 4*1024*1024)==[ (2*1024*1024, 2*1024*1024+4096) ]:
+			assert runs==[ (0, 2*1024*1024, False), (2*1024*1024, 4096, True), (2*1024*1024+4096, 2*1024*1024-4096, False) ]
+			assert maps.runs(f.fileno(), 2*1024*1024+100, 10)==[ (2*1024*1024+100, 10, True) ]
+			assert maps.runs(f.fileno(), 100, 10)==[ (100, 10, False) ]
+		assert maps.runs(f.fileno(), 4*1024*1024-5, 10)==[ (4*1024*1024-5, 10, True) ]
+	for p in (a, b): os.remove(p)
+	os.rmdir(d)
+	print("layout works")
+
+# ---------------------------------------------------------------------------
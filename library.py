@@ -0,0 +1,298 @@
+#!/usr/bin/python
+
+# ---------------------------------------------------------------------------
+#
+# Copyright (c) 2010 David Hanney
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# ---------------------------------------------------------------------------
+
+# for py2.5:
+from __future__ import division
+from __future__ import with_statement
+# for py3:
+from __future__ import print_function
+
+# ---------------------------------------------------------------------------
+
+import os
+import hashlib
+import sqlite3
+import collections
+
+import dlib
+import recursive_lister
+
+# ---------------------------------------------------------------------------
+#
+# An index of every file in a library and of the sha1 of each piece sized
+# window of them, starting from the beginning of the file, for a handful of
+# common piece lengths.
+#
+# A torrent file that starts on a piece boundary has its pieces' hashes
+# among those windows wherever in the library it now lives. One that does
+# not can still be narrowed down to the library files of the right size.
+#
+# ---------------------------------------------------------------------------
+
+DEFAULT_PIECE_LENGTHS = [ 256*1024, 512*1024, 1024*1024, 2*1024*1024, 4*1024*1024 ]
+
+SCHEMA = [
+	"create table if not exists files (id integer primary key, path text unique, size integer, mtime_ns integer)",
+	"create index if not exists files_by_size on files (size)",
+	"create table if not exists windows (digest blob, piece_length integer, file_id integer, offset integer)",
+	"create index if not exists windows_by_digest on windows (digest, piece_length)",
+	"create index if not exists windows_by_file on windows (file_id)",
+	]
+
+# ---------------------------------------------------------------------------
+
+def hash_windows(path, piece_lengths):
+	"""yields (piece_length, offset, sha1 digest) for each window of the file,
+	the last of each length being short if the file ends part way through it"""
+	piece_lengths = sorted(piece_lengths)
+	# every length is a multiple of the smallest so a chunk that size never straddles windows
+	for p in piece_lengths:
+		assert p % piece_lengths[0]==0
+	hashers = [ hashlib.sha1() for p in piece_lengths ]
+	position = 0
+	with open(path, 'rb') as f:
+		while True:
+			chunk = f.read(piece_lengths[0])
+			if not chunk: break
+			position += len(chunk)
+			for i, p in enumerate(piece_lengths):
+				hashers[i].update(chunk)
+				if position % p==0:
+					yield (p, position-p, hashers[i].digest())
+					hashers[i] = hashlib.sha1()
+	for i, p in enumerate(piece_lengths):
+		if position % p:
+			yield (p, position - position % p, hashers[i].digest())
+
+# ---------------------------------------------------------------------------
+
+class LibraryIndex(object):
+	def __init__(self, path):
+		self.path = path
+		self._db = sqlite3.connect(path)
+		self._db.text_factory = str
+		for statement in SCHEMA:
+			self._db.execute(statement)
+		self._db.commit()
+
+	def close(self):
+		self._db.close()
+
+	# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+	def update(self, roots, piece_lengths=DEFAULT_PIECE_LENGTHS, logger=None):
+		"""brings the index up to date with everything under roots, only hashing
+		files that are new or changed, and returns (hashed, unchanged, removed)"""
+		db = self._db
+		hashed = unchanged = removed = 0
+		seen = set()
+		def vanished(path):
+			if logger: logger.warn("No such file or directory: '{0}'.", path)
+		for root in roots:
+			root = os.path.abspath(root)
+			for path in recursive_lister.recursive_lister(root, vanished=vanished):
+				try:
+					st = os.stat(path)
+				except OSError as e:
+					# gone since it was listed
+					if logger: logger.warn("{0}: '{1}'.", e.strerror, path)
+					continue
+				mtime_ns = dlib.stat_mtime_ns(st)
+				seen.add(path)
+				row = db.execute("select id, size, mtime_ns from files where path=?", (path,)).fetchone()
+				if row and row[1:]==(st.st_size, mtime_ns) and self._has_lengths(row[0], piece_lengths, st.st_size):
+					unchanged += 1
+					continue
+				if logger: logger.debug("Hashing '{0}'.", path)
+				try:
+					windows = [ (sqlite3.Binary(digest), p, offset) for p, offset, digest in hash_windows(path, piece_lengths) ]
+				except EnvironmentError as e:
+					seen.discard(path)
+					if logger: logger.warn("{0}: '{1}'.", e.strerror, path)
+					continue
+				if row:
+					db.execute("delete from windows where file_id=?", (row[0],))
+					db.execute("update files set size=?, mtime_ns=? where id=?", (st.st_size, mtime_ns, row[0]))
+					file_id = row[0]
+				else:
+					file_id = db.execute("insert into files (path, size, mtime_ns) values (?, ?, ?)", (path, st.st_size, mtime_ns)).lastrowid
+				db.executemany("insert into windows (digest, piece_length, file_id, offset) values (?, ?, ?, ?)",
+					[ (digest, p, file_id, offset) for digest, p, offset in windows ])
+				db.commit()
+				hashed += 1
+			# forget what has gone from under this root
+			prefix = os.path.join(root, '')
+			for file_id, path in db.execute("select id, path from files where substr(path, 1, ?)=?", (len(prefix), prefix)).fetchall():
+				if path not in seen:
+					db.execute("delete from windows where file_id=?", (file_id,))
+					db.execute("delete from files where id=?", (file_id,))
+					removed += 1
+			db.commit()
+		return (hashed, unchanged, removed)
+
+	def _has_lengths(self, file_id, piece_lengths, size):
+		if not size: return True
+		have = set([ p for (p,) in self._db.execute("select distinct piece_length from windows where file_id=?", (file_id,)) ])
+		return have.issuperset(piece_lengths)
+
+	# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+	def files_of_size(self, size):
+		return [ path for (path,) in self._db.execute("select path from files where size=? order by path", (size,)) ]
+
+	def windows(self, digest, piece_length):
+		"""[ (path, offset, size of file) ] of the windows with this digest"""
+		return self._db.execute("select files.path, windows.offset, files.size from windows join files on files.id=windows.file_id"
+			" where windows.digest=? and windows.piece_length=? order by files.path",
+			(sqlite3.Binary(digest), piece_length)).fetchall()
+
+# ---------------------------------------------------------------------------
+#
+# Where a torrent's folder went when it was renamed or moved, worked out from
+# the sizes of the files in it alone - nothing is read.
+#
+# Every folder under the roots is summed up by the multiset of the sizes of
+# the files beneath it. A folder holding just the torrent's files has the
+# torrent's signature, and one with a few files added or missing still shares
+# nearly all of its sizes with the torrent.
+#
+# ---------------------------------------------------------------------------
+
+def size_signature(sizes):
+	"""a compact digest of a multiset of file sizes"""
+	return hashlib.sha1(' '.join([ str(s) for s in sorted(sizes) ]).encode('ascii')).digest()
+
+def overlap(a, b):
+	"""how alike two multisets of file sizes (Counters) are, from 0 to 1"""
+	common = sum([ min(n, b[s]) for s, n in a.items() ])
+	return common/max(sum(a.values()), sum(b.values()), 1)
+
+class FolderIndex(object):
+	# the roots are walked the first time a folder is looked for, so a run
+	# that finds every torrent folder where it should be never walks them
+	MIN_OVERLAP = 0.9
+	MAX_CANDIDATES = 3
+
+	def __init__(self, roots, ignore=()):
+		self.roots = roots
+		self.ignore = set(ignore)
+		self._sizes = None
+
+	def _scan(self):
+		self._sizes = {}
+		self._signatures = {}
+		self._with_size = {}
+		for root in self.roots:
+			root = os.path.abspath(root)
+			if not os.path.isdir(root): continue
+			for path in recursive_lister.recursive_lister(root):
+				if os.path.basename(path) in self.ignore: continue
+				size = os.path.getsize(path)
+				if not size: continue
+				folder = os.path.dirname(path)
+				while True:
+					self._sizes.setdefault(folder, []).append(size)
+					self._with_size.setdefault(size, set()).add(folder)
+					if folder==root: break
+					folder = os.path.dirname(folder)
+		for folder, sizes in self._sizes.items():
+			self._signatures.setdefault(size_signature(sizes), []).append(folder)
+
+	def candidates(self, sizes):
+		"""[ (folder, overlap) ] of the folders that most likely hold files of
+		these sizes, best first - the empty ones don't count"""
+		if self._sizes is None: self._scan()
+		sizes = sorted([ s for s in sizes if s ], reverse=True)
+		if not sizes: return []
+		found = [ (folder, 1.0) for folder in self._signatures.get(size_signature(sizes), []) ]
+		if not found:
+			# a folder sharing MIN_OVERLAP of the files can't be without all of
+			# the largest few of them, which only a few folders are likely to have
+			wanted = collections.Counter(sizes)
+			folders = set()
+			for s in sizes[:int(len(sizes)*(1-self.MIN_OVERLAP))+1]:
+				folders.update(self._with_size.get(s, ()))
+			for folder in folders:
+				score = overlap(wanted, collections.Counter(self._sizes[folder]))
+				if score>=self.MIN_OVERLAP: found.append( (folder, score) )
+		# deepest first so that of a folder and the folders above it that
+		# hold nothing else (or little else) only the folder itself is kept
+		found.sort(key=lambda x: (-x[1], -x[0].count(os.sep), x[0]))
+		answer = []
+		for folder, score in found:
+			if not any(f.startswith(os.path.join(folder, '')) for f, s in answer):
+				answer.append( (folder, score) )
+		return answer[:self.MAX_CANDIDATES]
+
+# ---------------------------------------------------------------------------
+
+if __name__ == "__main__":
+	import tempfile
+
+	d = tempfile.mkdtemp()
+	lib = os.path.join(d, 'lib')
+	os.mkdir(lib)
+	data = bytes(bytearray([ x % 253 for x in range(5000) ]))
+	dlib.save_file(os.path.join(lib, 'a'), data)
+	dlib.save_file(os.path.join(lib, 'b'), data[:1000])
+	assert sorted(hash_windows(os.path.join(lib, 'b'), [ 256, 512 ]))==[
+		(256, 0, hashlib.sha1(data[:256]).digest()), (256, 256, hashlib.sha1(data[256:512]).digest()),
+		(256, 512, hashlib.sha1(data[512:768]).digest()), (256, 768, hashlib.sha1(data[768:1000]).digest()),
+		(512, 0, hashlib.sha1(data[:512]).digest()), (512, 512, hashlib.sha1(data[512:1000]).digest()) ]
+	index = LibraryIndex(os.path.join(d, 'index'))
+	assert index.update([ lib ], [ 1024 ])==(2, 0, 0)
+	assert index.update([ lib ], [ 1024 ])==(0, 2, 0)
+	found = index.windows(hashlib.sha1(data[2048:3072]).digest(), 1024)
+	assert found==[ (os.path.join(lib, 'a'), 2048, 5000) ]
+	assert index.files_of_size(1000)==[ os.path.join(lib, 'b') ]
+	os.remove(os.path.join(lib, 'b'))
+	assert index.update([ lib ], [ 1024 ])==(0, 1, 1)
+	os.symlink(os.path.join(d, 'nowhere'), os.path.join(lib, 'dangling'))
+	assert index.update([ lib ], [ 1024 ])==(0, 1, 0)
+	os.remove(os.path.join(lib, 'dangling'))
+	index.close()
+	# a
+	# moved/renamed/{ x: 5000, y: 1000, .solution }
+	# other/{ z: 5000 }
+	os.makedirs(os.path.join(lib, 'moved', 'renamed'))
+	os.mkdir(os.path.join(lib, 'other'))
+	dlib.save_file(os.path.join(lib, 'moved', 'renamed', 'x'), data)
+	dlib.save_file(os.path.join(lib, 'moved', 'renamed', 'y'), data[:1000])
+	dlib.save_file(os.path.join(lib, 'moved', 'renamed', '.solution'), b'#')
+	dlib.save_file(os.path.join(lib, 'other', 'z'), data)
+	folders = FolderIndex([ lib ], ignore=[ '.solution' ])
+	assert folders.candidates([ 1000, 5000, 0 ])==[ (os.path.join(lib, 'moved', 'renamed'), 1.0) ]
+	assert folders.candidates([ 5000 ])==[ (os.path.join(lib, 'other'), 1.0) ]
+	assert folders.candidates([ 1000 ]*9+[ 5000 ]*2)==[]
+	folders.MIN_OVERLAP = 0.5
+	assert folders.candidates([ 1000, 5000, 77 ])==[ (os.path.join(lib, 'moved', 'renamed'), 2/3) ]
+	dlib.rm_minus_r(d)
+	print("library index works")
+
+# ---------------------------------------------------------------------------
@@ -69,7 +69,9 @@ if debug:
 		return s
 
 class Logger(object):
-	def __init__(self):
+	def __init__(self, stream=None):
+		# stream defaults to whatever sys.stdout is at the time of writing
+		self._stream = stream
 		self._on = set()
 		self._in_progress = False
 		self._progress_length = 0
@@ -96,7 +98,7 @@ class Logger(object):
 			s = t.format(*p, **d)
 			level_str = level_str_map[level]
 			line = "{0:10}: {1}{2}".format(level_str, self._indent * "    ", s)
-			if level==PROGRESS:
+			if level==PROGRESS and self.is_tty():
 				self._in_progress = True
 				ll = self._progress_length
 				self._progress_length = len(line)
@@ -114,13 +116,22 @@ class Logger(object):
 				self._bn = False
 				self._bf = line
 			else:
-				sys.stdout.write(self._bf + line)
-				sys.stdout.flush()
+				stream = self._stream or sys.stdout
+				stream.write(self._bf + line)
+				stream.flush()
 				self._bf = ""
 
 	def on(self, level):
 		return level in self._on
 
+	def get_stream(self):
+		return self._stream
+
+	def is_tty(self):
+		# progress is redrawn in place on a terminal and written out line by line anywhere else
+		isatty = getattr(self._stream or sys.stdout, 'isatty', None)
+		return bool(isatty and isatty())
+
 	def fatal(self, t, *p, **d):
 		self.log(FATAL, t, *p, **d)
 
@@ -182,7 +193,7 @@ if __name__ == "__main__":
 		with logger.indenter(INFO):
 			logger.info("hello!")
 			logger.info("hello {0} {name}!", 'fish', name='chips')
-	for x in xrange(1000, -1, -1):
+	for x in range(1000, -1, -1):
 		logger.progress("{0}% unfinished", x)
 	logger.info("there")
 
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+
+# ---------------------------------------------------------------------------
+#
+# Copyright (c) 2010 David Hanney
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# ---------------------------------------------------------------------------
+
+# for py2.5:
+from __future__ import division
+from __future__ import with_statement
+# for py3:
+from __future__ import print_function
+
+# ---------------------------------------------------------------------------
+
+import time
+import threading
+
+import dlib
+from logger import PROGRESS
+
+# ---------------------------------------------------------------------------
+#
+# Progress for a run over the pieces of a torrent.
+#
+# Callers report every piece but the line is only redrawn a few times a
+# second on a terminal, or written out as a one line summary every so often
+# when the output is going somewhere else. Any number of threads may report
+# to the same meter and it is their combined progress that is shown.
+#
+# Nothing at all is done unless the logger has PROGRESS switched on.
+#
+# ---------------------------------------------------------------------------
+
+DEFAULT_MAX_REDRAWS = 4				# per second on a terminal
+DEFAULT_SUMMARY_INTERVAL = 10		# seconds between summaries otherwise
+
+def format_duration(seconds):
+	seconds = int(seconds)
+	return '{0}:{1:02}:{2:02}'.format(seconds//3600, seconds//60 % 60, seconds % 60)
+
+class ProgressMeter(object):
+	# what   - what is being done to each piece, e.g. "Solving for"
+	# pieces - how many pieces there are in all
+
+	def __init__(self, logger, what, pieces, max_redraws=DEFAULT_MAX_REDRAWS, summary_interval=DEFAULT_SUMMARY_INTERVAL, clock=time.time):
+		self._logger = logger
+		self._active = logger.on(PROGRESS)
+		self._what = what
+		self._pieces = pieces
+		self._clock = clock
+		self._interval = 1/max_redraws if logger.is_tty() else summary_interval
+		self._lock = threading.Lock()
+		self._start = self._last_draw = clock()
+		self._drawn = False
+		self.position = 0
+		self.pieces_hashed = 0
+		self.bytes_hashed = 0
+		self.back_outs = 0
+
+	def update(self, position=None, pieces_hashed=0, bytes_hashed=0, back_outs=0):
+		if not self._active: return
+		with self._lock:
+			if position is not None: self.position = position
+			self.pieces_hashed += pieces_hashed
+			self.bytes_hashed += bytes_hashed
+			self.back_outs += back_outs
+			now = self._clock()
+			if self._drawn and now-self._last_draw<self._interval: return
+			self._draw(now)
+
+	def finish(self):
+		if not self._active: return
+		with self._lock:
+			if self._drawn: self._draw(self._clock())
+
+	def _draw(self, now):
+		self._last_draw = now
+		self._drawn = True
+		self._logger.progress('{0}', self.describe(now))
+
+	def describe(self, now):
+		elapsed = max(now-self._start, 1e-6)
+		piece_rate = self.pieces_hashed/elapsed
+		s = '{0} {1} piece {2} of {3}, {4}B/s, {5:.1f} pieces/s'.format(
+			dlib.generate_progress(self.position, max(1, self._pieces), 20), self._what, self.position, self._pieces,
+			dlib.gen_memsize(int(self.bytes_hashed/elapsed)).upper(), piece_rate)
+		if piece_rate and self.position<self._pieces:
+			s += ', ETA '+format_duration((self._pieces-self.position)/piece_rate)
+		if self.back_outs:
+			s += ', {0} back out(s)'.format(self.back_outs)
+		return s + '.'
+
+# ---------------------------------------------------------------------------
+
+if __name__ == "__main__":
+	try:
+		from StringIO import StringIO
+	except ImportError:
+		from io import StringIO
+	from logger import Logger, INFO
+
+	class Clock(object):
+		now = 100.0
+		def __call__(self): return self.now
+
+	out = StringIO()
+	logger = Logger(out)
+	clock = Clock()
+	meter = ProgressMeter(logger, 'Testing', 100, clock=clock)
+	meter.update(1, 1, 1024)
+	assert out.getvalue()==''
+	logger.switch_on(PROGRESS)
+	meter = ProgressMeter(logger, 'Testing', 100, summary_interval=10, clock=clock)
+	for piece in range(50):
+		clock.now += 0.25
+		meter.update(piece+1, 1, 1024*1024)
+	meter.update(back_outs=1)
+	meter.finish()
+	lines = out.getvalue().splitlines()
+	# not a terminal: a summary at the first piece, after 10 seconds and at the end
+	assert len(lines)==3, lines
+	assert lines[-1].endswith('[==========          ] Testing piece 50 of 100, 4MB/s, 4.0 pieces/s, ETA 0:00:12, 1 back out(s).'), lines[-1]
+	print("progress works")
+
+# ---------------------------------------------------------------------------
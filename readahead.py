@@ -0,0 +1,441 @@
+#!/usr/bin/python
+
+# ---------------------------------------------------------------------------
+#
+# Copyright (c) 2010 David Hanney
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# ---------------------------------------------------------------------------
+
+# for py2.5:
+from __future__ import division
+from __future__ import with_statement
+# for py3:
+from __future__ import print_function
+
+# ---------------------------------------------------------------------------
+
+import sys
+import hashlib
+import threading
+import collections
+
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+import os
+import dlib
+import layout
+import storage as storage_module
+import throttle as throttling
+
+# ---------------------------------------------------------------------------
+#
+# Hashes a stream of jobs, each a list of (path, start, length) segments,
+# with a reader thread filling a ring of reusable buffers while the calling
+# thread hashes the ones already filled. hashlib lets go of the GIL while it
+# works on a big buffer so the disk and the CPU get to work at the same time.
+#
+# A segment whose path is None (a pad file) is all zeros, as are the holes
+# in sparse files (see layout.py), and those are hashed from a shared buffer
+# of zeros without going near the disk. A job that is nothing but zeros - a
+# piece wholly in a hole of a half-downloaded file - isn't hashed at all: its
+# digest depends only on its length.
+#
+# Files under a folder mounted from elsewhere (see storage.py) are read
+# through their backend, which hands over the data in blocks of its own, and
+# the members of archives from where they are in the archive.
+#
+# hash_concurrently() instead works on several jobs at once, each read and
+# hashed in turn on a thread of its own, for when there are many small jobs
+# to try of which the first few will do - the solver's candidates for a piece.
+#
+# ---------------------------------------------------------------------------
+
+DEFAULT_QUEUE_DEPTH = 4
+DEFAULT_BUFFER_SIZE = 1024*1024
+
+# what the reader thread hands over
+_DATA = 0		# (_DATA, buffer, byte count)
+_END = 1		# (_END, job key, whether every segment could be read)
+_DONE = 2		# (_DONE, None, None)
+_FAILED = 3		# (_FAILED, exc_info, None)
+_ZEROS = 4		# (_ZEROS, byte count, None)
+
+_ZERO_BUFFER = bytearray(DEFAULT_BUFFER_SIZE)
+_zero_digests = {}
+
+def _hash_zeros(hasher, length):
+	while length:
+		n = min(length, len(_ZERO_BUFFER))
+		hasher.update(memoryview(_ZERO_BUFFER)[:n])
+		length -= n
+
+def zero_blocks(length):
+	# that many zeros as views of the shared buffer of them
+	while length:
+		n = min(length, len(_ZERO_BUFFER))
+		yield memoryview(_ZERO_BUFFER)[:n]
+		length -= n
+
+class _Hasher(object):
+	# a sha1 that holds back zeros until it sees data, so that an all zero
+	# job can have its digest looked up instead
+
+	def __init__(self):
+		self._sha1 = None
+		self._zeros = 0
+
+	def update(self, data):
+		if self._sha1 is None: self._sha1 = hashlib.sha1()
+		if self._zeros:
+			_hash_zeros(self._sha1, self._zeros)
+			self._zeros = 0
+		self._sha1.update(data)
+
+	def zeros(self, length):
+		self._zeros += length
+
+	def digest(self):
+		if self._sha1 is None:
+			if self._zeros not in _zero_digests:
+				sha1 = hashlib.sha1()
+				_hash_zeros(sha1, self._zeros)
+				_zero_digests[self._zeros] = sha1.digest()
+			return _zero_digests[self._zeros]
+		_hash_zeros(self._sha1, self._zeros)
+		return self._sha1.digest()
+
+class _Stop(Exception):
+	pass
+
+class _Slot(object):
+	# where a worker leaves the outcome of a job for the caller
+	def __init__(self):
+		self.done = threading.Event()
+		self.digest = None
+		self.failure = None
+
+class ReadAhead(object):
+	# queue_depth - buffers in the ring; 0 reads and hashes in turn on the calling thread
+	# buffer_size - bytes per buffer
+	# read_order  - what order the user of the reader should hand it pieces in (see layout.py)
+	# data_maps   - a layout.DataMaps to skip the holes in sparse files by, or None to read everything
+	# throttle    - a throttle.Throttle to wait on before each read, or None
+	# drop_behind - whether to let the page cache forget what has been read
+	# idle_io     - whether to read with the idle I/O priority
+	# hash_threads - how many jobs hash_concurrently() works on at once
+	# storage     - a storage.Storage saying where to read each path from
+
+	def __init__(self, queue_depth=DEFAULT_QUEUE_DEPTH, buffer_size=DEFAULT_BUFFER_SIZE, read_order='torrent', data_maps=layout.data_maps,
+			throttle=None, drop_behind=False, idle_io=False, hash_threads=1, storage=storage_module.local):
+		self.queue_depth = queue_depth
+		self.buffer_size = buffer_size
+		self.read_order = read_order
+		self.data_maps = data_maps
+		self.throttle = throttle
+		self.drop_behind = drop_behind
+		self.idle_io = idle_io
+		self.hash_threads = hash_threads
+		self.storage = storage
+
+	def hash(self, jobs):
+		"""for each (key, segments) in jobs yields (key, sha1 digest) or
+		(key, None) if any segment could not be read"""
+		hasher = _Hasher()
+		for kind, a, b in self._events(jobs):
+			if kind==_DATA:
+				hasher.update(memoryview(a)[:b])
+			elif kind==_ZEROS:
+				hasher.zeros(a)
+			else:
+				yield (a, hasher.digest() if b else None)
+				hasher = _Hasher()
+
+	def hash_concurrently(self, jobs):
+		"""as hash() but with up to hash_threads jobs being read and hashed at
+		once - the digests still come in job order, jobs is only ever advanced
+		on the calling thread, and once the caller stops listening the jobs
+		it was not going to get to are given up on"""
+		todo = queue.Queue()
+		stop = threading.Event()
+
+		def worker():
+			if self.idle_io: throttling.set_ioprio(throttling.IOPRIO_IDLE)
+			buf = bytearray(self.buffer_size)
+			def get_buffer():
+				if stop.is_set(): raise _Stop
+				return buf
+			while True:
+				job = todo.get()
+				if job is None: return
+				slot, key, segments = job
+				try:
+					slot.digest = self._hash_job(key, segments, get_buffer)
+				except _Stop:
+					pass
+				except:
+					slot.failure = sys.exc_info()
+				slot.done.set()
+
+		threads = [ threading.Thread(target=worker) for i in range(max(self.hash_threads, 1)) ]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+		jobs = iter(jobs)
+		pending = collections.deque()
+		try:
+			while True:
+				while len(pending)<len(threads):
+					job = next(jobs, None)
+					if job is None: break
+					slot = _Slot()
+					pending.append( (job[0], slot) )
+					todo.put( (slot, job[0], job[1]) )
+				if not pending: break
+				key, slot = pending.popleft()
+				slot.done.wait()
+				if slot.failure: dlib.reraise(slot.failure)
+				yield (key, slot.digest)
+		finally:
+			stop.set()
+			for thread in threads: todo.put(None)
+			for thread in threads: thread.join()
+
+	def blocks(self, jobs):
+		"""for each (key, segments) in jobs yields (key, block) for each block
+		of its data in turn - a memoryview good only until the next one - and
+		then, if a segment could not be read, (key, None)"""
+		for kind, a, b in self._events(jobs):
+			if kind==_DATA:
+				yield (None, memoryview(a)[:b])
+			elif kind==_ZEROS:
+				for block in zero_blocks(a):
+					yield (None, block)
+			elif not b:
+				yield (a, None)
+
+	# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+	def _segment(self, path, start, length, get_buffer, put_back=lambda buf: None):
+		# yields (buffer, byte count) as it reads and (None, byte count) for zeros
+		if path is None:
+			yield (None, length)
+			return
+		remote = self.storage.remote(path)
+		if remote:
+			for event in self._remote_segment(remote[0], remote[1], start, length, get_buffer, put_back):
+				yield event
+			return
+		member = self.storage.member(path)
+		if member:
+			# read in place from the archive
+			path, offset, size = member
+			if start+length>size: raise IOError("past the end of the member")
+			start += offset
+		with open(path, 'rb') as f:
+			runs = self.data_maps.runs(f.fileno(), start, length) if self.data_maps else [ (start, length, True) ]
+			dev = os.fstat(f.fileno()).st_dev if self.throttle else None
+			for start, length, is_data in runs:
+				if not is_data:
+					yield (None, length)
+					continue
+				f.seek(start)
+				if f.tell()!=start:
+					raise IOError("mis-seek")
+				while length:
+					buf = get_buffer()
+					want = min(len(buf), length)
+					try:
+						if self.throttle: self.throttle.read(dev, want)
+						got = f.readinto(memoryview(buf)[:want])
+						if got!=want:
+							raise IOError("under-read")
+					except:
+						put_back(buf)
+						raise
+					if self.drop_behind: throttling.drop_behind(f.fileno(), start, got)
+					yield (buf, got)
+					start += got
+					length -= got
+
+	def _remote_segment(self, backend, name, start, length, get_buffer, put_back):
+		# the backend's blocks copied into our buffers
+		buf = None
+		try:
+			for block in backend.blocks(name, start, length):
+				while len(block):
+					if buf is None:
+						buf = get_buffer()
+						filled = 0
+					n = min(len(buf)-filled, len(block))
+					# a backend is as much a device as a disk is
+					if self.throttle: self.throttle.read(backend, n)
+					buf[filled:filled+n] = block[:n]
+					filled += n
+					block = block[n:]
+					if filled==len(buf):
+						(full, buf) = (buf, None)
+						yield (full, filled)
+			if buf is not None:
+				(full, buf) = (buf, None)
+				yield (full, filled)
+		except:
+			if buf is not None: put_back(buf)
+			raise
+
+	def _hash_job(self, key, segments, get_buffer):
+		hasher = _Hasher()
+		for kind, a, b in self._job_events(key, segments, get_buffer):
+			if kind==_DATA:
+				hasher.update(memoryview(a)[:b])
+			elif kind==_ZEROS:
+				hasher.zeros(a)
+			else:
+				return hasher.digest() if b else None
+
+	def _job_events(self, key, segments, get_buffer, put_back=lambda buf: None):
+		try:
+			for path, start, length in segments:
+				for buf, n in self._segment(path, start, length, get_buffer, put_back):
+					yield (_DATA, buf, n) if buf is not None else (_ZEROS, n, None)
+		except (IOError, OSError):
+			yield (_END, key, False)
+		else:
+			yield (_END, key, True)
+
+	def _events(self, jobs):
+		# (_DATA, buffer, byte count), (_ZEROS, byte count, None) and (_END, key, ok)
+		# in turn for each job - a buffer is only good until the next event
+		if not self.queue_depth:
+			return self._events_inline(jobs)
+		return self._events_pipelined(jobs)
+
+	def _events_inline(self, jobs):
+		buf = bytearray(self.buffer_size)
+		# the reading is done on the caller's thread, which has to be given its priority back
+		prio = throttling.get_ioprio() if self.idle_io else None
+		if prio is not None: throttling.set_ioprio(throttling.IOPRIO_IDLE)
+		try:
+			for key, segments in jobs:
+				for event in self._job_events(key, segments, lambda: buf):
+					yield event
+		finally:
+			if prio is not None: throttling.set_ioprio(prio)
+
+	def _events_pipelined(self, jobs):
+		free = queue.Queue()
+		for i in range(self.queue_depth):
+			free.put(bytearray(self.buffer_size))
+		filled = queue.Queue()
+		stop = threading.Event()
+
+		def get_buffer():
+			buf = free.get()
+			if stop.is_set(): raise _Stop
+			return buf
+
+		def reader():
+			if self.idle_io: throttling.set_ioprio(throttling.IOPRIO_IDLE)
+			try:
+				for key, segments in jobs:
+					for event in self._job_events(key, segments, get_buffer, free.put):
+						filled.put(event)
+					if stop.is_set(): return
+				filled.put( (_DONE, None, None) )
+			except _Stop:
+				pass
+			except:
+				filled.put( (_FAILED, sys.exc_info(), None) )
+
+		thread = threading.Thread(target=reader)
+		thread.daemon = True
+		thread.start()
+		try:
+			while True:
+				kind, a, b = filled.get()
+				if kind==_DONE:
+					break
+				if kind==_FAILED:
+					dlib.reraise(a)
+				yield (kind, a, b)
+				if kind==_DATA: free.put(a)
+		finally:
+			# the caller may stop listening at any point, e.g. on the first bad piece
+			stop.set()
+			free.put(bytearray(0))
+			thread.join()
+
+# ---------------------------------------------------------------------------
+
+if __name__ == "__main__":
+	import tempfile
+
+	d = tempfile.mkdtemp()
+	p = os.path.join(d, 'data')
+	data = bytes(bytearray([ x % 251 for x in range(300000) ]))
+	with open(p, 'wb') as f: f.write(data)
+	jobs = [ (0, [ (p, 0, 100000) ]), (1, [ (p, 100000, 50000), (p, 0, 7) ]), (2, [ (p, 299990, 20) ]), (3, [ (p, 5, 5) ]),
+		(4, [ (p, 0, 10), (None, 0, 3000000) ]) ]
+	expected = [ (0, hashlib.sha1(data[:100000]).digest()), (1, hashlib.sha1(data[100000:150000]+data[:7]).digest()),
+		(2, None), (3, hashlib.sha1(data[5:10]).digest()), (4, hashlib.sha1(data[:10]+b'\0'*3000000).digest()) ]
+	for depth in (0, 1, 3):
+		assert list(ReadAhead(depth, 4096).hash(iter(jobs)))==expected
+	for depth in (0, 2):
+		got = [ b'' ]
+		for key, block in ReadAhead(depth, 4096).blocks(iter(jobs)):
+			if block is None:
+				got += [ key, b'' ]
+			else:
+				got[-1] += block.tobytes()
+		assert got==[ data[:150000]+data[:7], 2, data[5:10]+data[:10]+b'\0'*3000000 ]
+	# holes read as zeros whether or not we skip them
+	sparse = os.path.join(d, 'sparse')
+	with open(sparse, 'wb') as f:
+		f.truncate(3*1024*1024)
+		f.seek(1024*1024)
+		f.write(data)
+	jobs = [ (0, [ (sparse, 0, 1024*1024) ]), (1, [ (sparse, 1000000, 100000) ]), (2, [ (sparse, 0, 3*1024*1024) ]), (3, [ (sparse, 3*1024*1024-5, 10) ]) ]
+	expected = list(ReadAhead(0, 4096, data_maps=None).hash(iter(jobs)))
+	assert expected[0][1]==hashlib.sha1(b'\0'*1024*1024).digest() and expected[3][1] is None
+	for depth in (0, 2):
+		assert list(ReadAhead(depth, 4096).hash(iter(jobs)))==expected
+	for threads in (1, 3):
+		assert list(ReadAhead(0, 4096, hash_threads=threads).hash_concurrently(iter(jobs)))==expected
+	# throttled, dropping behind and idle read the same
+	for depth in (0, 2):
+		assert list(ReadAhead(depth, 4096, throttle=throttling.Throttle(10**9, 10**6), drop_behind=True, idle_io=True).hash(iter(jobs)))==expected
+	os.remove(sparse)
+	# stopping early must not leave the reader stuck
+	for key, digest in ReadAhead(2, 1024).hash(iter(jobs)):
+		break
+	for key, digest in ReadAhead(2, 1024, hash_threads=2).hash_concurrently(iter(jobs)):
+		break
+	assert threading.active_count()==1
+	os.remove(p)
+	os.rmdir(d)
+	print("readahead works")
+
+# ---------------------------------------------------------------------------
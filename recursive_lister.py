@@ -35,7 +35,7 @@ from __future__ import with_statement
 
 import os.path
 
-def internal_recursive_lister(path, answer, files, dir_before, dir_after):
+def internal_recursive_lister(path, answer, files, dir_before, dir_after, vanished=None):
 	if os.path.isfile(path):
 		if files:
 			answer.append(path)
@@ -46,15 +46,20 @@ def internal_recursive_lister(path, answer, files, dir_before, dir_after):
 		c.sort()
 		for x in c:
 			y = os.path.join(path, x)
-			internal_recursive_lister(y, answer, files, dir_before, dir_after)
+			if vanished and not os.path.exists(y):
+				# a dangling symlink, or gone since the listdir
+				vanished(y)
+				continue
+			internal_recursive_lister(y, answer, files, dir_before, dir_after, vanished)
 		if dir_after:
 			answer.append(path)
 	else:
 		raise Exception("Not found: "+path)
 
-def recursive_lister(path, files=True, dir_before=False, dir_after=False):
+def recursive_lister(path, files=True, dir_before=False, dir_after=False, vanished=None):
+	# vanished, if given, is told of what under path can't be found rather than that being an error
 	answer = []
-	internal_recursive_lister(path, answer, files, dir_before, dir_after)
+	internal_recursive_lister(path, answer, files, dir_before, dir_after, vanished)
 	return answer
 
 def recursive_lister_clipped(path, files=True, dir_before=False, dir_after=False):
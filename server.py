@@ -0,0 +1,209 @@
+#!/usr/bin/python
+
+# ---------------------------------------------------------------------------
+#
+# Copyright (c) 2010 David Hanney
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# ---------------------------------------------------------------------------
+
+# for py2.5:
+from __future__ import division
+from __future__ import with_statement
+# for py3:
+from __future__ import print_function
+
+# ---------------------------------------------------------------------------
+
+import os
+import errno
+import json
+import socket
+import threading
+
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+# ---------------------------------------------------------------------------
+#
+# A small daemon that takes requests as lines of JSON over a unix socket.
+#
+# The client sends one message and then reads back any number of
+#	{ "out": text }
+# messages followed by one
+#	{ "rc": exit value }
+#
+# Connections wait in a bounded queue for one of a fixed pool of workers.
+# When the queue is full the client is told so straight away rather than
+# being left hanging.
+#
+# ---------------------------------------------------------------------------
+
+BUSY_RC = 1
+
+def send_message(conn, message):
+	conn.sendall((json.dumps(message)+'\n').encode('utf-8'))
+
+def _plain(x):
+	# json gives us unicode but on python 2 the rest of torrentsolver works in byte strings
+	if str is bytes and isinstance(x, unicode): return x.encode('utf-8')
+	if isinstance(x, list): return [ _plain(y) for y in x ]
+	if isinstance(x, dict): return dict([ (_plain(k), _plain(v)) for k, v in x.items() ])
+	return x
+
+def read_messages(conn):
+	f = conn.makefile('rb')
+	try:
+		for line in f:
+			yield _plain(json.loads(line.decode('utf-8')))
+	finally:
+		f.close()
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+class SocketWriter(object):
+	# lets a Logger write straight back to the client
+	def __init__(self, conn):
+		self._conn = conn
+
+	def write(self, text):
+		send_message(self._conn, { 'out': text })
+
+	def flush(self):
+		pass
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+class Server(object):
+	# handle(message, stream) does the work and returns the exit value
+
+	def __init__(self, path, handle, workers=4, queue_size=16, logger=None):
+		self.path = path
+		self._handle = handle
+		self._queue = queue.Queue(queue_size)
+		self._workers = workers
+		self._logger = logger
+		self._listener = None
+
+	def _log(self, t, *p):
+		if self._logger: self._logger.info(t, *p)
+
+	def _bind(self):
+		try:
+			os.remove(self.path)
+		except OSError as e:
+			if e.errno!=errno.ENOENT: raise
+		self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		# whoever can connect can have us read and write as we please, so only
+		# we can - the umask covers the moment between bind and chmod
+		umask = os.umask(0o177)
+		try:
+			self._listener.bind(self.path)
+		finally:
+			os.umask(umask)
+		os.chmod(self.path, 0o600)
+		self._listener.listen(self._queue.maxsize)
+
+	def _work(self):
+		while True:
+			conn = self._queue.get()
+			try:
+				self._serve_one(conn)
+			except socket.error:
+				# the client went away - nothing we can tell it
+				pass
+			finally:
+				conn.close()
+
+	def _serve_one(self, conn):
+		for message in read_messages(conn):
+			try:
+				rc = self._handle(message, SocketWriter(conn))
+			except Exception as e:
+				send_message(conn, { 'out': "error     : {0}\n".format(e) })
+				rc = 1
+			send_message(conn, { 'rc': rc })
+			return
+
+	def serve_forever(self):
+		self._bind()
+		for i in range(self._workers):
+			t = threading.Thread(target=self._work)
+			t.daemon = True
+			t.start()
+		self._log("Listening on '{0}' with {1} worker(s).", self.path, self._workers)
+		try:
+			while True:
+				conn, address = self._listener.accept()
+				try:
+					self._queue.put_nowait(conn)
+				except queue.Full:
+					send_message(conn, { 'out': "error     : Server busy.\n", 'rc': BUSY_RC })
+					conn.close()
+		finally:
+			self._listener.close()
+			os.remove(self.path)
+
+# ---------------------------------------------------------------------------
+
+def request(path, message, write):
+	"""send message to the server at path, passing its output to write and
+	returning its exit value - or None if there is no server there"""
+	conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		try:
+			conn.connect(path)
+		except socket.error:
+			return None
+		send_message(conn, message)
+		for reply in read_messages(conn):
+			if 'out' in reply: write(reply['out'])
+			if 'rc' in reply: return reply['rc']
+		return 1
+	finally:
+		conn.close()
+
+# ---------------------------------------------------------------------------
+
+if __name__ == "__main__":
+	import tempfile
+	import time
+	import sys
+
+	path = os.path.join(tempfile.mkdtemp(), 'socket')
+	def handle(message, stream):
+		stream.write("hello "+message['who']+"\n")
+		return 7
+	t = threading.Thread(target=Server(path, handle, workers=2).serve_forever)
+	t.daemon = True
+	t.start()
+	while not os.path.exists(path): time.sleep(0.01)
+	out = []
+	assert request(path, { 'who': 'fish' }, out.append)==7
+	assert out==[ "hello fish\n" ]
+	assert request(path+'.nothing', {}, out.append) is None
+	print("server works")
+
+# ---------------------------------------------------------------------------
@@ -0,0 +1,486 @@
+#!/usr/bin/python
+
+# ---------------------------------------------------------------------------
+#
+# Copyright (c) 2010 David Hanney
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# ---------------------------------------------------------------------------
+
+# for py2.5:
+from __future__ import division
+from __future__ import with_statement
+# for py3:
+from __future__ import print_function
+
+# ---------------------------------------------------------------------------
+
+import os
+import re
+import sys
+import errno
+import threading
+import collections
+
+from email.utils import parsedate_tz, mktime_tz
+
+try:
+	from httplib import HTTPConnection, HTTPSConnection, HTTPException
+except ImportError:
+	from http.client import HTTPConnection, HTTPSConnection, HTTPException
+
+try:
+	from urlparse import urlsplit
+	from urllib import quote, unquote as unquote_to_bytes
+except ImportError:
+	from urllib.parse import urlsplit, quote, unquote_to_bytes
+
+import dlib
+import archives as archives_module
+import recursive_lister
+
+# ---------------------------------------------------------------------------
+#
+# Where the data is read from: the local filesystem, except under folders
+# "mounted" from elsewhere - so far an HTTP server (an object store's
+# gateway, say) that answers Range requests.
+#
+# An HttpBackend keeps its connections open between requests and fetches a
+# file in requests of up to request_size, no more than connections of them
+# at once. Reads that carry on where the last read of a file left off, as
+# the pieces of a torrent do, have the requests after them made before they
+# are asked for, so neighbouring reads end up as a few big requests.
+#
+# Folders are listed from the server's own index pages (the links in them
+# ending in / are folders) and files stat'ed with HEAD.
+#
+# With archives on, the stored members of local zip and tar files are files
+# too (see archives.py), read from where they are in the archive.
+#
+# ---------------------------------------------------------------------------
+
+class Storage(object):
+	# the local filesystem with any folders mounted from elsewhere
+	# archives - whether to take the members of archives as files
+
+	def __init__(self, archives=False):
+		self.archives = archives
+		self._mounts = []
+		self._archives = archives_module.Archives()
+
+	def mount(self, folder, backend):
+		self._mounts.append( (os.path.abspath(folder), backend) )
+		# the deepest first
+		self._mounts.sort(key=lambda mount: -len(mount[0]))
+
+	def remote(self, path):
+		"""(backend, name within it) if path is under a mounted folder, else None"""
+		if not self._mounts: return None
+		path = os.path.abspath(path)
+		for folder, backend in self._mounts:
+			if path==folder: return (backend, '')
+			if path.startswith(folder.rstrip(os.sep)+os.sep):
+				return (backend, path[len(folder.rstrip(os.sep))+1:].replace(os.sep, '/'))
+		return None
+
+	def member(self, path):
+		"""(archive path, offset, size) if path is a member of a local archive, else None"""
+		if not self.archives or self.remote(path): return None
+		return self._archives.member(path)
+
+	def elsewhere(self, path):
+		"""whether path is not a file of its own here - it is on a server or in an archive"""
+		return bool(self.remote(path) or self.member(path))
+
+	def stat(self, path):
+		remote = self.remote(path)
+		if remote: return remote[0].stat(remote[1])
+		member = self.member(path)
+		# anything done to the archive may have been done to the member
+		if member: return RemoteStat(member[2], os.stat(member[0]).st_mtime)
+		return os.stat(path)
+
+	def isdir(self, path):
+		remote = self.remote(path)
+		if remote: return remote[0].isdir(remote[1])
+		return os.path.isdir(path) or self.archives and self._archives.isdir(path)
+
+	def listing(self, path):
+		"""the files under the folder path, as recursive_lister has them"""
+		remote = self.remote(path)
+		if remote: return [ os.path.join(path, *name.split('/')) for name in remote[0].listing(remote[1]) ]
+		if self.archives: return self._archives.listing(path)
+		return recursive_lister.recursive_lister(path)
+
+# the one to use unless told otherwise: nothing mounted
+local = Storage()
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+DEFAULT_CONNECTIONS = 4
+DEFAULT_REQUEST_SIZE = 4*1024*1024
+
+class RemoteStat(object):
+	# as much of an os.stat() result as a server will tell us
+	def __init__(self, size, mtime):
+		self.st_size = size
+		self.st_mtime = mtime
+
+class _Connections(object):
+	# open connections to one server, each used by one request at a time
+
+	def __init__(self, scheme, netloc, timeout):
+		self._connection_class = HTTPSConnection if scheme=='https' else HTTPConnection
+		self._netloc = netloc
+		self._timeout = timeout
+		self._idle = []
+		self._lock = threading.Lock()
+
+	def request(self, method, url, headers={}):
+		"""(status, response, body)"""
+		for attempt in (0, 1):
+			with self._lock:
+				connection = self._idle.pop() if self._idle else None
+			if connection is None:
+				connection = self._connection_class(self._netloc, timeout=self._timeout)
+			try:
+				connection.request(method, url, headers=headers)
+				response = connection.getresponse()
+				body = response.read()
+			except (HTTPException, EnvironmentError) as e:
+				connection.close()
+				# the server may have closed a connection we had kept
+				if attempt: raise IOError("{0} {1} failed: {2}".format(method, url, e))
+				continue
+			if (response.getheader('connection') or '').lower()=='close':
+				connection.close()
+			else:
+				with self._lock:
+					self._idle.append(connection)
+			return (response.status, response, body)
+
+	def close(self):
+		with self._lock:
+			idle, self._idle = self._idle, []
+		for connection in idle: connection.close()
+
+class _Request(object):
+	# a range being fetched, for the thread that wants it to wait on
+	def __init__(self, start, length):
+		self.start = start
+		self.length = length
+		self.done = threading.Event()
+		self.cancelled = False
+		self.data = None
+		self.failure = None
+
+class _Stream(object):
+	# the requests for a file from where it is being read on
+	def __init__(self, name, offset):
+		self.name = name
+		self.offset = offset
+		self.fetched_to = offset
+		self.pending = collections.deque()
+		self.sequential = False
+
+	def cancel(self):
+		for request in self.pending: request.cancelled = True
+		self.pending.clear()
+
+class HttpBackend(object):
+	# url          - the folder on the server that the mounted folder is
+	# connections  - the most requests to have going at once
+	# request_size - the most to ask for in one request
+
+	def __init__(self, url, connections=DEFAULT_CONNECTIONS, request_size=DEFAULT_REQUEST_SIZE, timeout=60):
+		parts = urlsplit(url)
+		if parts.scheme not in ('http', 'https') or not parts.netloc:
+			raise ValueError("Not an http or https url: '{0}'.".format(url))
+		self.url = url
+		self.connections = connections
+		self.request_size = request_size
+		self._base = parts.path.rstrip('/')
+		self._connections = _Connections(parts.scheme, parts.netloc, timeout)
+		self._window = threading.Semaphore(connections)
+		self._lock = threading.Lock()
+		self._streams = []
+		self._stats = {}
+
+	def _url(self, name, folder=False):
+		url = self._base+'/'+quote(dlib.fs_bytes(name)) if name else self._base
+		return url+'/' if folder else url
+
+	# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+	def stat(self, name):
+		with self._lock:
+			if name in self._stats: return self._stats[name]
+		status, response, body = self._connections.request('HEAD', self._url(name))
+		if status==404:
+			raise OSError(errno.ENOENT, "No such file on the server", name)
+		if status!=200 or response.getheader('content-length') is None:
+			raise OSError(errno.EIO, "HEAD gave {0} {1}".format(status, response.reason), name)
+		modified = response.getheader('last-modified')
+		modified = modified and parsedate_tz(modified)
+		st = RemoteStat(int(response.getheader('content-length')), float(mktime_tz(modified)) if modified else 0.0)
+		with self._lock:
+			self._stats[name] = st
+		return st
+
+	def isdir(self, name):
+		try:
+			status, response, body = self._connections.request('HEAD', self._url(name, True))
+		except EnvironmentError:
+			return False
+		return status==200
+
+	def _entries(self, name):
+		# (names, folder names) linked to from the folder's index page
+		status, response, body = self._connections.request('GET', self._url(name, True))
+		if status!=200:
+			raise OSError(errno.ENOENT if status==404 else errno.EIO, "Can't list the folder on the server", name)
+		files = set()
+		folders = set()
+		for href in re.findall(br'href="([^"?#]+)"', body):
+			href = _unescape(href)
+			# only what is in the folder itself, not links up, away or to other sites
+			if href.startswith(b'/') or b'://' in href or href.startswith(b'../') or href==b'./': continue
+			if href.endswith(b'/'):
+				folders.add(dlib.fs_str(unquote_to_bytes(href[:-1].decode('ascii'))))
+			elif b'/' not in href:
+				files.add(dlib.fs_str(unquote_to_bytes(href.decode('ascii'))))
+		return (files, folders)
+
+	def listing(self, name, within=''):
+		"""the names of the files under the folder, relative to it"""
+		answer = []
+		files, folders = self._entries(name)
+		for x in sorted(files | folders):
+			y = name+'/'+x if name else x
+			if x in folders:
+				answer.extend(self.listing(y, within+x+'/'))
+			else:
+				answer.append(within+x)
+		return answer
+
+	# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+	def _fetch(self, name, start, length):
+		status, response, body = self._connections.request('GET', self._url(name), { 'Range': 'bytes={0}-{1}'.format(start, start+length-1) })
+		if status==206:
+			# bytes <start>-<end>/<size>
+			m = re.match(r'bytes (\d+)-', response.getheader('content-range') or '')
+			if not m or int(m.group(1))!=start: raise IOError("wrong range from server")
+			return body
+		if status==200:
+			# a server that ignores Range sends the lot
+			return body[start:start+length]
+		raise IOError("GET of {0} gave {1} {2}".format(name, status, response.reason))
+
+	def _run(self, name, request):
+		with self._window:
+			if not request.cancelled:
+				try:
+					request.data = self._fetch(name, request.start, request.length)
+				except:
+					request.failure = sys.exc_info()
+		request.done.set()
+
+	def _fill(self, stream, end):
+		# requests up to end, and while the reads keep on from one another
+		# up to connections requests ahead of it
+		limit = end+self.connections*self.request_size if stream.sequential else end
+		if limit>end:
+			# but never past the end of the file (stat is cached)
+			try:
+				limit = min(limit, max(self.stat(stream.name).st_size, end))
+			except EnvironmentError:
+				limit = end
+		while stream.fetched_to<limit and len(stream.pending)<self.connections:
+			n = min(self.request_size, limit-stream.fetched_to)
+			request = _Request(stream.fetched_to, n)
+			thread = threading.Thread(target=self._run, args=(stream.name, request))
+			thread.daemon = True
+			thread.start()
+			stream.pending.append(request)
+			stream.fetched_to += n
+
+	def _stream(self, name, start):
+		with self._lock:
+			for i, stream in enumerate(self._streams):
+				if stream.name==name and stream.offset==start:
+					del self._streams[i]
+					stream.sequential = True
+					return stream
+			# the file is being read from somewhere else now
+			for stream in [ s for s in self._streams if s.name==name ]:
+				stream.cancel()
+				self._streams.remove(stream)
+			# and only so many are kept going
+			while len(self._streams)>=self.connections:
+				self._streams.pop(0).cancel()
+		return _Stream(name, start)
+
+	def blocks(self, name, start, length):
+		"""the data of that much of the file in turn, as memoryviews"""
+		stream = self._stream(name, start)
+		end = start+length
+		try:
+			while stream.offset<end:
+				self._fill(stream, end)
+				request = stream.pending[0]
+				request.done.wait()
+				if request.failure:
+					stream.cancel()
+					dlib.reraise(request.failure)
+				have = request.start+len(request.data)
+				want = min(end, request.start+request.length)
+				if have<want:
+					stream.cancel()
+					raise IOError("under-read")
+				yield memoryview(request.data)[stream.offset-request.start:want-request.start]
+				stream.offset = want
+				if want==request.start+request.length: stream.pending.popleft()
+		finally:
+			with self._lock:
+				self._streams.append(stream)
+
+	def close(self):
+		"""gives up on the reads ahead and closes the connections"""
+		with self._lock:
+			for stream in self._streams: stream.cancel()
+			self._streams = []
+		self._connections.close()
+
+_ENTITIES = [ (b'&quot;', b'"'), (b'&#39;', b"'"), (b'&#x27;', b"'"), (b'&lt;', b'<'), (b'&gt;', b'>'), (b'&amp;', b'&') ]
+
+def _unescape(href):
+	for entity, c in _ENTITIES:
+		href = href.replace(entity, c)
+	return href
+
+# ---------------------------------------------------------------------------
+
+if __name__ == "__main__":
+	import tempfile
+	import shutil
+
+	try:
+		from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+		from SocketServer import ThreadingMixIn
+	except ImportError:
+		from http.server import HTTPServer, BaseHTTPRequestHandler
+		from socketserver import ThreadingMixIn
+
+	# stands in for the gateway: Range requests, index pages and keep-alive
+	class Handler(BaseHTTPRequestHandler):
+		protocol_version = 'HTTP/1.1'
+
+		def log_message(self, *a):
+			pass
+
+		def do_HEAD(self):
+			self.do_GET(False)
+
+		def do_GET(self, send_body=True):
+			self.server.requests.append( (self.command, self.path, self.headers.get('Range')) )
+			path = os.path.join(self.server.root, dlib.fs_str(unquote_to_bytes(self.path)).lstrip('/'))
+			if os.path.isdir(path) and self.path.endswith('/'):
+				status = 200
+				body = b''.join([ b'<a href="'+quote(dlib.fs_bytes(x)+(b'/' if os.path.isdir(os.path.join(path, x)) else b'')).encode('ascii')+b'">x</a>\n'
+					for x in sorted(os.listdir(path)) ])
+				body = b'<a href="../">up</a>\n<a href="?C=M">sort</a>\n'+body
+			elif os.path.isfile(path):
+				status = 200
+				body = dlib.load_file(path)
+				m = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range') or '')
+				if m:
+					a, b = int(m.group(1)), min(int(m.group(2)), len(body)-1)
+					if a>=len(body):
+						status, body = 416, b''
+					else:
+						status = 206
+						self.server.ranges.append( (a, b+1-a) )
+						content_range = 'bytes {0}-{1}/{2}'.format(a, b, len(body))
+						body = body[a:b+1]
+			else:
+				status, body = 404, b''
+			self.send_response(status)
+			if status==206: self.send_header('Content-Range', content_range)
+			if os.path.isfile(path): self.send_header('Last-Modified', self.date_time_string(int(os.path.getmtime(path))))
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			if send_body: self.wfile.write(body)
+
+	class Server(ThreadingMixIn, HTTPServer):
+		daemon_threads = True
+
+	d = tempfile.mkdtemp()
+	os.makedirs(os.path.join(d, 'a b', 'c'))
+	data = bytes(bytearray([ x % 253 for x in range(1000000) ]))
+	dlib.save_file(os.path.join(d, 'a b', 'big'), data)
+	dlib.save_file(os.path.join(d, 'a b', 'c', 'small&odd'), b'hello')
+	server = Server(('127.0.0.1', 0), Handler)
+	server.root = d
+	server.requests = []
+	server.ranges = []
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+
+	storage = Storage()
+	backend = HttpBackend('http://127.0.0.1:{0}/a%20b/'.format(server.server_address[1]), connections=2, request_size=64*1024)
+	storage.mount('/archive', backend)
+	assert storage.remote('/archive/c/small&odd')==(backend, 'c/small&odd') and storage.remote('/archived') is None
+	assert storage.listing('/archive')==[ '/archive/big', '/archive/c/small&odd' ]
+	assert storage.listing('/archive/c')==[ '/archive/c/small&odd' ]
+	assert storage.isdir('/archive/c') and not storage.isdir('/archive/d')
+	assert storage.stat('/archive/big').st_size==1000000 and abs(storage.stat('/archive/big').st_mtime-os.path.getmtime(os.path.join(d, 'a b', 'big')))<1
+	try:
+		storage.stat('/archive/nothing')
+		assert False
+	except OSError as e:
+		assert e.errno==errno.ENOENT
+	# one connection kept open for all of those
+	assert len(backend._connections._idle)==1
+	# reads on from one another become a few big requests
+	got = b''
+	for start in range(0, 1000000, 10000):
+		got += b''.join([ block.tobytes() for block in backend.blocks('big', start, min(10000, 1000000-start)) ])
+	assert got==data
+	assert len(server.ranges)<=1000000//(64*1024)+3 and sum([ length for start, length in server.ranges ])<1000000+3*64*1024
+	assert b''.join([ block.tobytes() for block in backend.blocks('c/small&odd', 1, 3) ])==b'ell'
+	try:
+		list(backend.blocks('big', 999990, 20))
+		assert False
+	except IOError:
+		pass
+	backend.close()
+	server.shutdown()
+	server.server_close()
+	for t in threading.enumerate():
+		if t is not threading.current_thread(): t.join()
+	shutil.rmtree(d)
+	print("storage works")
+
+# ---------------------------------------------------------------------------
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+
+# ---------------------------------------------------------------------------
+#
+# Copyright (c) 2010 David Hanney
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# ---------------------------------------------------------------------------
+
+# for py2.5:
+from __future__ import division
+from __future__ import with_statement
+# for py3:
+from __future__ import print_function
+
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import platform
+import threading
+
+try:
+	import ctypes
+	import ctypes.util
+except ImportError:
+	ctypes = None
+
+# ---------------------------------------------------------------------------
+#
+# Keeps a check from getting in the way of whatever else is using the disks,
+# such as a torrent client seeding from the very same files.
+#
+#	Throttle   - a limit on bytes read per second overall and on reads per
+#	             second per device, each a token bucket
+#	drop_behind - tells the kernel the data just read won't be wanted again,
+#	             so hashing a whole library doesn't push out of the page
+#	             cache what peers are being served from
+#	idle I/O   - the ioprio idle class, so the reads only get the disk when
+#	             nobody else wants it
+#
+# ---------------------------------------------------------------------------
+
+class TokenBucket(object):
+	# rate  - tokens a second
+	# burst - the most that can be saved up (default a second's worth)
+
+	def __init__(self, rate, burst=None, clock=time.time):
+		self.rate = rate
+		self.burst = burst or rate
+		self._clock = clock
+		self._tokens = self.burst
+		self._last = clock()
+
+	def take(self, n):
+		"""takes n tokens, going into debt if there aren't enough, and
+		returns how many seconds to wait before using them"""
+		now = self._clock()
+		self._tokens = min(self.burst, self._tokens+(now-self._last)*self.rate)
+		self._last = now
+		self._tokens -= n
+		return max(0, -self._tokens/self.rate)
+
+class Throttle(object):
+	# shared by every reader of a run so the limits are for all of them together
+	# max_read_rate - bytes a second, or None
+	# max_iops      - reads a second on each device, or None
+
+	def __init__(self, max_read_rate=None, max_iops=None, clock=time.time, sleep=time.sleep):
+		self.max_read_rate = max_read_rate
+		self.max_iops = max_iops
+		self._clock = clock
+		self._sleep = sleep
+		self._lock = threading.Lock()
+		self._bytes = TokenBucket(max_read_rate, clock=clock) if max_read_rate else None
+		self._ops = {}
+
+	def read(self, dev, length):
+		"""waits until reading length bytes from device dev is allowed"""
+		with self._lock:
+			wait = self._bytes.take(length) if self._bytes else 0
+			if self.max_iops:
+				if dev not in self._ops: self._ops[dev] = TokenBucket(self.max_iops, clock=self._clock)
+				wait = max(wait, self._ops[dev].take(1))
+		if wait: self._sleep(wait)
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+POSIX_FADV_DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', 4)
+
+def _libc():
+	if ctypes is None or not sys.platform.startswith('linux'): return None
+	try:
+		return ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+	except OSError:
+		return None
+
+_libc = _libc()
+
+def drop_behind(fd, start, length):
+	"""lets the kernel drop that much of the open file from the page cache"""
+	try:
+		if hasattr(os, 'posix_fadvise'):
+			os.posix_fadvise(fd, start, length, POSIX_FADV_DONTNEED)
+		elif _libc is not None:
+			# python 2 has no os.posix_fadvise
+			_libc.posix_fadvise64(fd, ctypes.c_int64(start), ctypes.c_int64(length), POSIX_FADV_DONTNEED)
+	except (OSError, AttributeError):
+		# only ever advice
+		pass
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+# ioprio_get and ioprio_set from linux/ioprio.h, which libc doesn't wrap
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_IDLE = IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+
+# (ioprio_set, ioprio_get) by machine
+_IOPRIO_SYSCALLS = {
+	'x86_64': (251, 252),
+	'i386': (289, 290),
+	'i686': (289, 290),
+	'aarch64': (30, 31),
+	'armv7l': (314, 315),
+	'armv6l': (314, 315),
+	}
+
+def _syscalls():
+	if _libc is None: return None
+	return _IOPRIO_SYSCALLS.get(platform.machine())
+
+def get_ioprio():
+	"""the I/O priority of the calling thread, or None if it can't be had"""
+	calls = _syscalls()
+	if calls is None: return None
+	prio = _libc.syscall(calls[1], IOPRIO_WHO_PROCESS, 0)
+	return prio if prio>=0 else None
+
+def set_ioprio(prio):
+	"""sets the I/O priority of the calling thread, True if it could be"""
+	calls = _syscalls()
+	if calls is None or prio is None: return False
+	return _libc.syscall(calls[0], IOPRIO_WHO_PROCESS, 0, prio)==0
+
+# ---------------------------------------------------------------------------
+
+if __name__ == "__main__":
+	import tempfile
+
+	now = [ 0.0 ]
+	waits = []
+	bucket = TokenBucket(1000, clock=lambda: now[0])
+	assert bucket.take(600)==0 and bucket.take(600)==0.2
+	now[0] = 1.0
+	assert bucket.take(400)==0 and abs(bucket.take(500)-0.1)<1e-9
+	throttle = Throttle(max_iops=10, clock=lambda: now[0], sleep=waits.append)
+	for i in range(12): throttle.read(1, 4096)
+	throttle.read(2, 4096)
+	assert len(waits)==2 and abs(waits[0]-0.1)<1e-9 and abs(waits[1]-0.2)<1e-9
+	d = tempfile.mkdtemp()
+	p = os.path.join(d, 'data')
+	with open(p, 'wb') as f: f.write(b'x'*100000)
+	with open(p, 'rb') as f:
+		f.read()
+		drop_behind(f.fileno(), 0, 100000)
+	os.remove(p)
+	os.rmdir(d)
+	# only the thread that asks goes idle
+	prio = get_ioprio()
+	if prio is not None:
+		got = []
+		thread = threading.Thread(target=lambda: got.append(set_ioprio(IOPRIO_IDLE) and get_ioprio()))
+		thread.start()
+		thread.join()
+		assert got==[ IOPRIO_IDLE ] and get_ioprio()==prio
+	print("throttle works")
+
+# ---------------------------------------------------------------------------
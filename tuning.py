@@ -0,0 +1,273 @@
+#!/usr/bin/python
+
+# ---------------------------------------------------------------------------
+#
+# Copyright (c) 2010 David Hanney
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# ---------------------------------------------------------------------------
+
+# for py2.5:
+from __future__ import division
+from __future__ import with_statement
+# for py3:
+from __future__ import print_function
+
+# ---------------------------------------------------------------------------
+
+import os
+import time
+import json
+import hashlib
+import threading
+
+import dlib
+import recursive_lister
+import readahead
+import throttle
+
+# ---------------------------------------------------------------------------
+#
+# Per device tuning of how data is read and hashed.
+#
+# "calibrate" times reading some of a data folder with each buffer size and
+# read-ahead depth and times hashing on one and then several threads. The
+# best of each is kept in a profile under the folder's st_dev, and solve and
+# check read each torrent's data with the settings for its device.
+#
+# ---------------------------------------------------------------------------
+
+PROFILE_ENVIRONMENT_VARIABLE = 'TORRENTSOLVER_TUNING'
+DEFAULT_PROFILE_PATH = '~/.torrentsolver-tuning'
+
+BUFFER_SIZES = [ 64*1024, 256*1024, 1024*1024, 4*1024*1024 ]
+QUEUE_DEPTHS = [ 0, 2, 4, 8 ]
+JOB_SIZE = 4*1024*1024
+
+# a setting has to beat the best so far by this much to be worth switching to
+MARGIN = 1.05
+
+def default_profile_path():
+	return os.path.expanduser(os.environ.get(PROFILE_ENVIRONMENT_VARIABLE, DEFAULT_PROFILE_PATH))
+
+def device_of(path):
+	while not os.path.exists(path):
+		parent = os.path.dirname(path)
+		if parent==path: break
+		path = parent
+	return str(os.stat(path or '.').st_dev)
+
+# ---------------------------------------------------------------------------
+
+class Profiles(object):
+	# { st_dev: { 'buffer_size': ..., 'queue_depth': ..., 'workers': ..., ... } }
+
+	def __init__(self, path=None):
+		self.path = path or default_profile_path()
+		self.devices = {}
+		if os.path.exists(self.path):
+			with open(self.path, 'r') as f:
+				self.devices = json.load(f)
+
+	def for_path(self, path):
+		return self.devices.get(device_of(os.path.abspath(path)))
+
+	def store(self, path, profile):
+		self.devices[device_of(os.path.abspath(path))] = profile
+		dlib.save_text_atomically(self.path, [ json.dumps(self.devices, indent=1, sort_keys=True) ])
+
+class Tuning(object):
+	# hands out a reader for the data a .torrent refers to - set up from the
+	# profile for its device except where the command line says otherwise
+
+	# profile_path - where the profiles are, or None to go without
+	# overrides    - ReadAhead settings, and max_read_rate and max_iops for
+	#                a throttle shared by all the readers handed out
+	#
+	# path is where the data is, as it is that device's profile that counts
+
+	def __init__(self, profile_path=None, overrides=None):
+		self.profile_path = profile_path
+		self.overrides = overrides or {}
+		self._profiles = None
+		self._throttle = None
+
+	def settings_for(self, path):
+		settings = {}
+		if self._profiles is None and self.profile_path:
+			self._profiles = Profiles(self.profile_path)
+		# a device here says nothing of how to read from a server
+		storage = self.overrides.get('storage')
+		profile = self._profiles and not (storage and storage.remote(path)) and self._profiles.for_path(path)
+		if profile:
+			settings.update((k, profile[k]) for k in ('queue_depth', 'buffer_size') if k in profile)
+			if 'workers' in profile: settings['hash_threads'] = profile['workers']
+		settings.update(self.overrides)
+		limits = dict((k, settings.pop(k)) for k in ('max_read_rate', 'max_iops') if k in settings)
+		if limits:
+			if self._throttle is None: self._throttle = throttle.Throttle(**limits)
+			settings['throttle'] = self._throttle
+		return settings
+
+	def reader_for(self, path):
+		return readahead.ReadAhead(**self.settings_for(path))
+
+# ---------------------------------------------------------------------------
+
+class _Cursor(object):
+	# walks on through the sample files so each trial, as far as the data
+	# lasts, reads something the trials before it did not
+	def __init__(self, files):
+		self._files = files
+		self._file = 0
+		self._offset = 0
+		self.wrapped = False
+
+	def next_job(self):
+		path, size = self._files[self._file]
+		length = min(JOB_SIZE, size-self._offset)
+		job = [ (path, self._offset, length) ]
+		self._offset += length
+		if self._offset>=size:
+			self._offset = 0
+			self._file += 1
+			if self._file==len(self._files):
+				self._file = 0
+				self.wrapped = True
+		return job
+
+def _timed_jobs(cursor, seconds, counter):
+	end = time.time()+seconds
+	while time.time()<end:
+		job = cursor.next_job()
+		counter[0] += sum(length for path, start, length in job)
+		yield (None, job)
+
+def measure_read(cursor, queue_depth, buffer_size, seconds):
+	counter = [0]
+	start = time.time()
+	# every byte really read, holes or not, or sparse files would flatter the disk
+	for key, digest in readahead.ReadAhead(queue_depth, buffer_size, data_maps=None).hash(_timed_jobs(cursor, seconds, counter)):
+		pass
+	return counter[0]/max(time.time()-start, 1e-6)
+
+def measure_hash(threads, seconds, buffer_size=1024*1024):
+	# hashlib lets go of the GIL for big buffers so this shows how hashing scales over cores
+	block = bytearray(buffer_size)
+	counts = [ 0 ]*threads
+	end = time.time()+seconds
+	def work(i):
+		hasher = hashlib.sha1()
+		while time.time()<end:
+			hasher.update(block)
+			counts[i] += len(block)
+	start = time.time()
+	workers = [ threading.Thread(target=work, args=(i,)) for i in range(threads) ]
+	for t in workers: t.start()
+	for t in workers: t.join()
+	return sum(counts)/max(time.time()-start, 1e-6)
+
+def _best(results):
+	# the first of the settings (listed cheapest first) within MARGIN of the fastest
+	fastest = max(rate for setting, rate in results)
+	for setting, rate in results:
+		if rate*MARGIN>=fastest: return (setting, rate)
+
+def calibrate(folder, seconds=1, logger=None, cpus=None):
+	def log(t, *p):
+		if logger: logger.info(t, *p)
+
+	if not os.path.isdir(folder):
+		raise IOError("No such folder as '{0}'.".format(folder))
+	files = []
+	for path in recursive_lister.recursive_lister(folder):
+		size = os.path.getsize(path)
+		if size: files.append( (path, size) )
+	if not files:
+		raise IOError("No data to calibrate with in '{0}'.".format(folder))
+	cursor = _Cursor(files)
+
+	reads = []
+	for buffer_size in BUFFER_SIZES:
+		for queue_depth in QUEUE_DEPTHS:
+			rate = measure_read(cursor, queue_depth, buffer_size, seconds)
+			log("Reading with {0} buffers {1} deep: {2}B/s.", dlib.gen_memsize(buffer_size), queue_depth, dlib.gen_memsize(int(rate)).upper())
+			reads.append( ((buffer_size, queue_depth), rate) )
+	if cursor.wrapped:
+		log("The data ran out and was read again so later trials may have been helped by the cache.")
+	(buffer_size, queue_depth), read_rate = _best(reads)
+
+	cpus = cpus or _cpu_count()
+	counts = sorted(set([ 1, 2, 4, cpus ]))
+	hashes = []
+	for threads in counts:
+		rate = measure_hash(threads, seconds/2)
+		log("Hashing on {0} thread(s): {1}B/s.", threads, dlib.gen_memsize(int(rate)).upper())
+		hashes.append( (threads, rate) )
+	workers, hash_rate = _best(hashes)
+
+	return {
+		'path': os.path.abspath(folder),
+		'measured': int(time.time()),
+		'buffer_size': buffer_size,
+		'queue_depth': queue_depth,
+		'read_rate': int(read_rate),
+		'workers': workers,
+		'hash_rate_per_core': int(hashes[0][1]),
+		'hash_rate': int(hash_rate),
+		}
+
+def _cpu_count():
+	try:
+		import multiprocessing
+		return multiprocessing.cpu_count()
+	except (ImportError, NotImplementedError):
+		return 1
+
+# ---------------------------------------------------------------------------
+
+if __name__ == "__main__":
+	import tempfile
+
+	d = tempfile.mkdtemp()
+	dlib.save_file(os.path.join(d, 'data'), b'x'*(3*1024*1024))
+	profiles = Profiles(os.path.join(d, 'profiles'))
+	profile = calibrate(d, seconds=0.05)
+	assert profile['buffer_size'] in BUFFER_SIZES and profile['queue_depth'] in QUEUE_DEPTHS
+	profiles.store(d, profile)
+	tuning = Tuning(os.path.join(d, 'profiles'), { 'queue_depth': 3 })
+	reader = tuning.reader_for(os.path.join(d, 'data'))
+	assert reader.buffer_size==profile['buffer_size'] and reader.queue_depth==3 and reader.hash_threads==profile['workers']
+	tuning.overrides['max_read_rate'] = 1024*1024
+	reader = tuning.reader_for(os.path.join(d, 'data'))
+	assert reader.throttle.max_read_rate==1024*1024 and tuning.reader_for(d).throttle is reader.throttle
+	import storage
+	tuning.overrides['storage'] = storage.Storage()
+	tuning.overrides['storage'].mount(d, storage.HttpBackend('http://127.0.0.1:1/'))
+	settings = tuning.settings_for(os.path.join(d, 'data'))
+	assert 'buffer_size' not in settings and settings['queue_depth']==3
+	assert _best([ ('a', 100), ('b', 104), ('c', 90) ])==('a', 100)
+	dlib.rm_minus_r(d)
+	print("tuning works")
+
+# ---------------------------------------------------------------------------